@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import importlib
+import statistics
+import tracemalloc
+from datetime import datetime, timezone
+
+# Make the stage modules and config importable the way main.py does
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repository_dir)
+sys.path.append(os.path.join(repository_dir, 'mypythonlib_nasim_project'))
+
+import synthetic_corpus
+
+# Chapter sizes in characters benchmarked by default
+default_sizes = [10000, 50000, 200000]
+
+# Number of words in the synthetic words dictionary
+dictionary_size = 5000
+
+# Function to build the stage functions to time, each taking the text it is
+# given: a whole 'book', a 'chapter', or a 'marked' chapter holding the
+# liaison markers. Stages whose module cannot be imported are returned with the error.
+def load_stage_functions(dictionary_file, titles):
+    stage_functions = {}
+    skipped = {}
+
+    def add(name, module_name, build, kind='chapter'):
+        try:
+            stage_functions[name] = (build(importlib.import_module(module_name)), kind)
+        except Exception as e:
+            skipped[name] = f"{type(e).__name__}: {e}"
+
+    add('remove_pnum_hilight_title.process_text', 'remove_pnum_hilight_title',
+        lambda module: lambda text: module.process_text(text, module.phrases_to_remove, titles), 'book')
+    add('split_chapters.split_book', 'split_chapters', lambda module: module.split_book, 'book')
+    add('clean_text.clean_text', 'clean_text', lambda module: module.clean_text)
+    add('clean_text.process_text', 'clean_text', lambda module: module.process_text)
+    add('replace_numbers.replace_numbers_with_words', 'replace_numbers',
+        lambda module: module.replace_numbers_with_words)
+    add('fix_lines.fix_line_breaks', 'fix_lines', lambda module: module.fix_line_breaks)
+    add('fix_lines.process_text', 'fix_lines', lambda module: module.process_text)
+    add('liaisons.identify_and_replace_liaisons', 'liaisons', lambda module: module.identify_and_replace_liaisons)
+    add('ent_ait_fix.process_text', 'ent_ait_fix', lambda module: module.process_text, 'marked')
+
+    def build_replace_words(module):
+        word_pairs, matcher, sequential_words = module.load_matcher(dictionary_file)
+        return lambda text: module.replace_words(text, word_pairs, matcher, sequential_words)
+    add('replace_words.replace_words', 'replace_words', build_replace_words, 'marked')
+
+    add('replace_special_chars.replace_special_chars', 'replace_special_chars',
+        lambda module: module.replace_special_chars, 'marked')
+    add('name_correction.extract_and_replace_names', 'name_correction',
+        lambda module: module.extract_and_replace_names)
+
+    return stage_functions, skipped
+
+# Function to forget the parses kept between stages, so every run parses its text
+def clear_parse_cache():
+    shared_nlp = sys.modules.get('shared_nlp')
+    if shared_nlp is not None:
+        shared_nlp.clear_cache()
+
+# Function to time a stage function on a text, then measure its peak memory in a separate run
+def measure(function, text, repeat):
+    # Warm up, which also loads the SpaCy model outside of the measures
+    clear_parse_cache()
+    function(text)
+
+    timings = []
+    for _ in range(repeat):
+        clear_parse_cache()
+        start_time = time.perf_counter()
+        function(text)
+        timings.append(time.perf_counter() - start_time)
+
+    clear_parse_cache()
+    tracemalloc.start()
+    try:
+        function(text)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    seconds = statistics.median(timings)
+    return {
+        'seconds': seconds,
+        'min_seconds': min(timings),
+        'chars_per_second': len(text) / seconds if seconds else None,
+        'peak_memory_bytes': peak_memory,
+    }
+
+# Function to run every stage function on chapters of every size
+def run_benchmarks(sizes, repeat, seed=0, only=None):
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        dictionary_file = os.path.join(temporary_directory, 'words_dictionary.json')
+        with open(dictionary_file, 'w', encoding='utf-8') as file:
+            json.dump(synthetic_corpus.make_words_dictionary(dictionary_size, seed), file, ensure_ascii=False)
+
+        # Books are made of chapters of book_chapter_size characters
+        book_chapter_size = 10000
+        titles = [f"Chapitre {number} Le chapitre numéro {number}"
+                  for number in range(1, max(sizes) // book_chapter_size + 2)]
+        stage_functions, skipped = load_stage_functions(dictionary_file, titles)
+        if only:
+            stage_functions = {name: stage for name, stage in stage_functions.items()
+                               if any(part in name for part in only)}
+
+        results = []
+        for size in sizes:
+            chapter = synthetic_corpus.make_chapter(1, size, seed)
+            book, _ = synthetic_corpus.make_book(max(1, size // book_chapter_size), book_chapter_size, seed)
+            texts = {'book': book, 'chapter': chapter, 'marked': synthetic_corpus.mark_liaisons(chapter)}
+            for name, (function, kind) in stage_functions.items():
+                text = texts[kind]
+                try:
+                    result = measure(function, text, repeat)
+                except Exception as e:
+                    skipped[name] = f"{type(e).__name__}: {e}"
+                    continue
+                result.update({'stage': name, 'size': size, 'chars': len(text)})
+                results.append(result)
+                print(f"{name:<48} {len(text):>9} chars {result['seconds']:>9.4f} s "
+                      f"{result['chars_per_second']:>14,.0f} chars/s {result['peak_memory_bytes'] / 1e6:>9.2f} MB")
+
+    for name, reason in skipped.items():
+        print(f"Skipped {name}: {reason}")
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+        'skipped': skipped,
+    }
+
+# Function to compare a run with a previous one, printing the change in throughput of every stage
+def compare_runs(previous, current):
+    previous_results = {(result['stage'], result['size']): result for result in previous['results']}
+    for result in current['results']:
+        before = previous_results.get((result['stage'], result['size']))
+        if before is None or not before['chars_per_second']:
+            continue
+        ratio = result['chars_per_second'] / before['chars_per_second']
+        print(f"{result['stage']:<48} {result['size']:>9} chars {ratio:>7.2f}x throughput")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of the pipeline on synthetic French chapters.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes,
+                        help="Chapter sizes in characters")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage and size")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument('--stage', action='append', dest='only',
+                        help="Only run the stages whose name contains this text, can be repeated")
+    parser.add_argument('--output', help="File to save the results to as JSON")
+    parser.add_argument('--compare', help="Results of a previous run to compare with")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    run = run_benchmarks(args.sizes, args.repeat, args.seed, args.only)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(run, file, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare_runs(json.load(file), run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import re
+import random
+
+# Building blocks of the synthetic French chapters. Every sentence template
+# exercises at least one stage: liaisons (est un, c'est une, ils ont, les
+# enfants), plural endings for ent_ait_fix, numbers, character names and
+# words that get split by a hyphen at the end of a line.
+names = [
+    "Martinez", "Bernard", "Lucas", "Gauthier", "Duchamp", "Perrault", "Thomas",
+    "Mercier", "Boris", "Dubois", "Rivière", "Lefort", "Chevalier", "Morel",
+]
+
+subjects = ["Le garçon", "La vieille femme", "Le professeur", "L'enfant", "Le capitaine"]
+
+sentence_templates = [
+    "{name} est un homme étrange qui habite au {number} rue des Lilas.",
+    "C'est une histoire que les enfants aiment entendre le soir.",
+    "Ils ont marché pendant {number} minutes avant d'arriver aux portes.",
+    "Elles étaient parties depuis {number} jours et les amis attendaient.",
+    "{subject} regardait les étoiles qui brillaient au-dessus des toits.",
+    "Les hommes parlaient et les femmes écoutaient les histoires anciennes.",
+    "Quand {name} entra, {other} leva les yeux et sourit.",
+    "Il n'est pas certain que {name} revienne avant l'année {year}.",
+    "Les oiseaux chantaient, et les arbres immenses dansaient sous le vent.",
+    "Qu'elles arrivent ou non, nous devons commencer à {number} heures.",
+    "{subject} voulait parler à {name} des plans secrets de l'école.",
+    "Ils étaient assis dans les jardins et regardaient les nuages passer.",
+]
+
+hyphenated_words = [
+    "pro-blème", "mer-veilleux", "ordi-nateur", "chan-son", "bâti-ment",
+    "soi-rée", "mon-tagne", "fenê-tre", "jour-née", "mai-son",
+]
+
+# Function to build one sentence from the templates
+def make_sentence(rng):
+    template = rng.choice(sentence_templates)
+    return template.format(
+        name=rng.choice(names),
+        other=rng.choice(names),
+        subject=rng.choice(subjects),
+        number=rng.randint(1, 999999) if rng.random() < 0.2 else rng.randint(1, 60),
+        year=rng.randint(1900, 2030),
+    )
+
+# Function to build one paragraph, with some lines broken by a hyphen
+def make_paragraph(rng):
+    sentences = [make_sentence(rng) for _ in range(rng.randint(2, 6))]
+    if rng.random() < 0.5:
+        first, second = rng.choice(hyphenated_words).split('-')
+        sentences.insert(rng.randint(0, len(sentences)), f"Un {first}-\n{second} de plus.")
+    return " ".join(sentences)
+
+# Function to build a chapter of about the requested number of characters
+def make_chapter(number, size, seed=0):
+    rng = random.Random(f"{seed}-{number}-{size}")
+    paragraphs = [f"@@ Chapitre {number} Le chapitre numéro {number} @@"]
+    length = len(paragraphs[0])
+    while length < size:
+        paragraph = make_paragraph(rng)
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+# Function to build a book made of several chapters, with its list of titles
+def make_book(chapter_count, chapter_size, seed=0):
+    chapters = [make_chapter(number, chapter_size, seed) for number in range(1, chapter_count + 1)]
+    titles = [f"Chapitre {number} Le chapitre numéro {number}" for number in range(1, chapter_count + 1)]
+
+    # Remove the markers so that the title stage has something to find, and
+    # end a page every few paragraphs with its number
+    paragraphs = "\n\n".join(chapters).replace("@@ ", "").replace(" @@", "").split("\n\n")
+    for position in range(5, len(paragraphs), 6):
+        paragraphs[position] += f" {position // 6 + 1}"
+    book = "Titre du livre\nAuteur\n\n" + "\n\n".join(paragraphs)
+    return book, titles
+
+# Function to add the liaison markers the liaisons stage would, for the stages running after it
+def mark_liaisons(text):
+    return re.sub(r"(?<=\w)s(?= [aeiouhéà])", "#@%", text)
+
+# Function to build a words dictionary in the format of words_dictionary.json
+def make_words_dictionary(size, seed=0):
+    rng = random.Random(f"{seed}-dictionary-{size}")
+    word_pairs = {name: name.lower() for name in names}
+    while len(word_pairs) < size:
+        word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyzéè") for _ in range(rng.randint(4, 10)))
+        word_pairs[word] = word.upper()
+    return {"mots": word_pairs}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Make the stages importable the way main.py does
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(base_dir)
+
+import metrics
+import pipeline
+
+# Name of the directory the outputs of a book are written to, inside the book directory
+default_output_name = "txt_processed"
+
+# Stages of a book, in the order they complete
+book_stages = ([pipeline.page_number_directory, pipeline.chapter_split_directory]
+               + [subdirectory for subdirectory, _ in pipeline.chapter_stages])
+
+# Function to find the output directory of a book, inside the book directory or in an output root
+def book_output_directory(book_directory, output_root=None):
+    if output_root is None:
+        return os.path.join(book_directory, default_output_name)
+    return os.path.join(output_root, os.path.basename(os.path.normpath(book_directory)))
+
+# Function to add an event to the manifest of the batch. Every event is one
+# JSON line written with a single append and synced to disk, so the manifest
+# survives a crash or a kill and several processes can add to it at once.
+def append_manifest(manifest_file, book, event, **details):
+    record = {'book': book, 'event': event, 'time': datetime.now(timezone.utc).isoformat(), **details}
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with open(manifest_file, 'a', encoding='utf-8') as file:
+        file.write(line)
+        file.flush()
+        os.fsync(file.fileno())
+
+# Function to read the state of every book from the manifest: its status
+# ('running', 'done' or 'failed'), the stages it completed and its last error.
+# A line cut short by a crash is ignored.
+def read_manifest(manifest_file):
+    books = {}
+    if not os.path.exists(manifest_file):
+        return books
+    with open(manifest_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            book = books.setdefault(record['book'], {'status': None, 'stages': [], 'error': None})
+            if record['event'] == 'started':
+                book.update(status='running', stages=[], error=None)
+            elif record['event'] == 'stage':
+                book['stages'].append(record['stage'])
+            elif record['event'] == 'done':
+                book['status'] = 'done'
+            elif record['event'] == 'failed':
+                book.update(status='failed', error=record.get('error'))
+    return books
+
+# Function to take one book through every stage, in a worker process. The
+# stages completed by an earlier run are reused from the build cache of the
+# book, so an interrupted book resumes after its last completed stage.
+def run_book(book_directory, output_directory, manifest_file, keep_intermediates=False, use_cache=True):
+    append_manifest(manifest_file, book_directory, 'started')
+    if not os.path.isdir(book_directory):
+        append_manifest(manifest_file, book_directory, 'failed', error="Not a directory")
+        return False
+
+    metrics.reset()
+    start_time = time.time()
+    try:
+        cache_directory = os.path.join(output_directory, '.build_cache') if use_cache else None
+        chapters = pipeline.run_pipeline(
+            book_directory, output_directory, keep_intermediates, cache_directory=cache_directory,
+            journal_file=os.path.join(output_directory, 'changes.jsonl'), write_chapter_logs=False,
+            stage_done=lambda subdirectory: append_manifest(manifest_file, book_directory, 'stage',
+                                                            stage=subdirectory))
+        metrics.export(os.path.join(output_directory, 'metrics.jsonl'))
+    except Exception as e:
+        logging.exception(f"Error processing the book {book_directory}")
+        append_manifest(manifest_file, book_directory, 'failed', error=f"{type(e).__name__}: {e}")
+        return False
+
+    if not chapters:
+        append_manifest(manifest_file, book_directory, 'failed', error="No chapters found")
+        return False
+
+    # Chapters a stage failed on are left out of the output, so the book has to be run again
+    errors = sum(record['value'] for record in metrics.collect() if record['metric'] == 'stage_errors')
+    if errors:
+        append_manifest(manifest_file, book_directory, 'failed',
+                        error=f"{errors} chapter stages failed, see the processing log")
+        return False
+
+    append_manifest(manifest_file, book_directory, 'done', seconds=time.time() - start_time)
+    return True
+
+# Function to run every book not done yet, with at most jobs books at a time.
+# Returns the books that failed.
+def run_batch(book_directories, manifest_file, jobs=1, output_root=None, keep_intermediates=False,
+              use_cache=True, rerun=False):
+    books = read_manifest(manifest_file)
+    pending = []
+    for book_directory in book_directories:
+        book_directory = os.path.abspath(book_directory)
+        state = books.get(book_directory)
+        if state is not None and state['status'] == 'done' and not rerun:
+            logging.info(f"Skipping {book_directory}, already done")
+            continue
+        if state is not None and state['stages'] and use_cache:
+            logging.info(f"Resuming {book_directory} after stage {state['stages'][-1]}")
+        pending.append(book_directory)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=pipeline.init_worker) as executor:
+        futures = {executor.submit(run_book, book_directory, book_output_directory(book_directory, output_root),
+                                   manifest_file, keep_intermediates, use_cache): book_directory
+                   for book_directory in pending}
+        for future in as_completed(futures):
+            book_directory = futures[future]
+            try:
+                succeeded = future.result()
+            except Exception as e:
+                # The worker itself died, like when it runs out of memory
+                append_manifest(manifest_file, book_directory, 'failed', error=f"{type(e).__name__}: {e}")
+                succeeded = False
+            if succeeded:
+                logging.info(f"Finished {book_directory}")
+            else:
+                logging.error(f"Failed {book_directory}")
+                failed.append(book_directory)
+    return failed
+
+# Function to print the state of every book of the manifest
+def print_status(manifest_file):
+    for book, state in sorted(read_manifest(manifest_file).items()):
+        last_stage = state['stages'][-1] if state['stages'] else "-"
+        print(f"{state['status'] or '-':<8} {len(state['stages']):>2}/{len(book_stages)} {last_stage:<28} {book}")
+        if state['status'] == 'failed' and state['error']:
+            print(f"         {state['error']}")
+
+# Function to read the book directories listed in a file, one per line
+def read_book_list(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Atlas pipeline over many books, resuming after a crash.")
+    parser.add_argument("books", nargs="*", help="book directories holding the .txt files of a book")
+    parser.add_argument("--books-file", help="file listing book directories, one per line")
+    parser.add_argument("--manifest", default="batch_manifest.jsonl",
+                        help="manifest recording the progress of every book, read again to resume")
+    parser.add_argument("--jobs", type=int, default=1, help="number of books processed at the same time")
+    parser.add_argument("--output-root", default=None,
+                        help=f"directory the outputs of every book go to, in the book's {default_output_name} "
+                             f"directory by default")
+    parser.add_argument("--keep-intermediates", action="store_true",
+                        help="write the output of every stage of every book for debugging")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not reuse the stages of earlier runs, so interrupted books start over")
+    parser.add_argument("--rerun", action="store_true", help="run the books the manifest marks as done again")
+    parser.add_argument("--status", action="store_true", help="print the state of every book of the manifest and exit")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.status:
+        print_status(args.manifest)
+        return
+
+    book_directories = list(args.books)
+    if args.books_file:
+        book_directories.extend(read_book_list(args.books_file))
+
+    failed = run_batch(book_directories, args.manifest, args.jobs, args.output_root, args.keep_intermediates,
+                       not args.no_cache, args.rerun)
+    if failed:
+        print(f"{len(failed)} books failed, run the batch again to retry them:")
+        for book_directory in failed:
+            print(f"  {book_directory}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
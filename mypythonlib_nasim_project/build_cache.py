@@ -0,0 +1,104 @@
+import os
+import ast
+import json
+import types
+import hashlib
+import logging
+
+# Version of the layout of the cache entries, part of every fingerprint
+cache_format_version = 2
+
+# Function to hash a text
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Function to hash the content of a file, or mark it as missing
+def hash_file(file_path):
+    if not os.path.exists(file_path):
+        return 'missing'
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to list a stage module and every module of the package it depends on
+def source_modules(module):
+    package_directory = os.path.dirname(os.path.abspath(module.__file__))
+    found = {}
+    pending = [module]
+    while pending:
+        current = pending.pop()
+        path = os.path.abspath(current.__file__)
+        if path in found:
+            continue
+        found[path] = current
+        for value in vars(current).values():
+            value_file = getattr(value, '__file__', None)
+            if (isinstance(value, types.ModuleType) and value_file
+                    and os.path.dirname(os.path.abspath(value_file)) == package_directory):
+                pending.append(value)
+    return [found[path] for path in sorted(found)]
+
+# Function to read the source of a module for its fingerprint. The tables a
+# module names in indexed_tables are left out: the stage covers them through
+# indexed_rules(), in the cache key of every chapter they apply to.
+def module_source(module):
+    with open(module.__file__, 'rb') as file:
+        source = file.read()
+    indexed_tables = getattr(module, 'indexed_tables', ())
+    if not indexed_tables:
+        return source
+    tree = ast.parse(source)
+    tree.body = [node for node in tree.body
+                 if not (isinstance(node, ast.Assign)
+                         and any(isinstance(target, ast.Name) and target.id in indexed_tables
+                                 for target in node.targets))]
+    return ast.dump(tree).encode('utf-8')
+
+# Function to fingerprint the code and data of a stage. The data covers what
+# each of its modules declares through a cache_data() function, like the
+# SpaCy model version; lists written in the code, like the titles, are
+# covered by the source itself. The words dictionary and the name rules are
+# covered chapter by chapter instead, see cache_key.
+def stage_fingerprint(module):
+    digest = hashlib.sha256(f"build-cache-{cache_format_version}".encode('utf-8'))
+    for source_module in source_modules(module):
+        digest.update(module_source(source_module))
+        if hasattr(source_module, 'cache_data'):
+            data = source_module.cache_data()
+            digest.update(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+# Function to build the cache key of a stage input. The rules are the data of
+# the rules of the stage applying to the input, when the stage has indexed
+# rules, so changing a rule only changes the keys of the chapters it applies to.
+def cache_key(fingerprint, text, rules=None):
+    if rules is not None:
+        fingerprint += '\0' + hash_text(json.dumps(rules, ensure_ascii=False))
+    return hash_text(fingerprint + '\0' + text)
+
+def _entry_path(cache_directory, key):
+    return os.path.join(cache_directory, key[:2], f"{key}.json")
+
+# Function to load the output, log entries and journal changes cached for a key, or None
+def load_entry(cache_directory, key):
+    entry_path = _entry_path(cache_directory, key)
+    if not os.path.exists(entry_path):
+        return None
+    try:
+        with open(entry_path, 'r', encoding='utf-8') as file:
+            entry = json.load(file)
+        return entry['text'], entry['log_entries'], [tuple(change) for change in entry['changes']]
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Ignoring unreadable cache entry {entry_path}: {e}")
+        return None
+
+# Function to store the output, log entries and journal changes of a stage input
+def store_entry(cache_directory, key, text, log_entries, changes=()):
+    entry_path = _entry_path(cache_directory, key)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    temporary_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump({'text': text, 'log_entries': log_entries, 'changes': list(changes)}, file, ensure_ascii=False)
+    os.replace(temporary_path, entry_path)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import os
 import re
+
+import journal
 from config import base_dir  # Import the base directory
 
 def clean_text(text):
@@ -31,19 +33,57 @@ def clean_text(text):
 
     return text
 
+# Spaces, other than line breaks, that clean_text removes from a paragraph: at
+# the start and end of the line, around hyphens, before punctuation and after em dashes
+paragraph_spaces_pattern = re.compile(r'^[^\S\n]+|[^\S\n]+$|[^\S\n]+(?=[-.,!?;:])|(?<=[-—])[^\S\n]+', re.MULTILINE)
+
+# Punctuation directly followed by a character other than a space
+punctuation_pattern = re.compile(r'([.,!?;:])([^\s])')
+
+# Title markers, removed from the paragraphs
+marker_pattern = re.compile('@@')
+
+# Function to record the changes a substitution makes to a text, at their offsets in it
+def journal_substitution(pattern, replacement, text):
+    for match in pattern.finditer(text):
+        journal.add(match.start(), match.group(), match.expand(replacement))
+
+# Function to clean every paragraph of a text at once, giving the same output as
+# clean_text applied to each line. Within a line the line break rules of
+# clean_text never match and every other rule only removes spaces next to
+# a fixed set of characters, so they can all be applied in a single pass.
+def clean_paragraphs(text):
+    if not journal.is_recording():
+        text = paragraph_spaces_pattern.sub('', text.replace('@@', ''))
+        return punctuation_pattern.sub(r'\1 \2', text)
+
+    with journal.steps() as step:
+        with step():
+            journal_substitution(marker_pattern, '', text)
+        text = text.replace('@@', '')
+        with step():
+            journal_substitution(paragraph_spaces_pattern, '', text)
+        text = paragraph_spaces_pattern.sub('', text)
+        with step():
+            journal_substitution(punctuation_pattern, r'\1 \2', text)
+    return punctuation_pattern.sub(r'\1 \2', text)
+
+# Function to clean a whole chapter paragraph by paragraph
+def process_text(text):
+    return clean_paragraphs(text), []
+
+# Function to clean a stream of lines paragraph by paragraph, yielding every
+# line as soon as it is cleaned
+def clean_lines(lines):
+    for line in lines:
+        yield clean_paragraphs(line)
+
+# Function to clean a file, reading and writing it one paragraph at a time
 def process_text_file(input_file_path, output_file_path):
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        text = file.read()
-
-    # Split text into paragraphs
-    paragraphs = text.split('\n')
-
-    cleaned_paragraphs = [clean_text(paragraph) for paragraph in paragraphs]
-
-    cleaned_text = '\n'.join(cleaned_paragraphs)
-
-    with open(output_file_path, 'w', encoding='utf-8') as file:
-        file.write(cleaned_text)
+    with open(input_file_path, 'r', encoding='utf-8') as input_file, \
+            open(output_file_path, 'w', encoding='utf-8') as output_file:
+        for cleaned_line in clean_lines(input_file):
+            output_file.write(cleaned_line)
 
 def process_directory(input_directory, output_directory):
     if not os.path.exists(output_directory):
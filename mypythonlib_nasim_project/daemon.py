@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import socketserver
+
+# Make the stages importable the way main.py does
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(base_dir)
+
+import lexicon
+import metrics
+import pipeline
+import replace_words
+import shared_nlp
+
+# Socket the daemon listens on by default
+default_socket_path = os.path.join(tempfile.gettempdir(), f"atlas-pipeline-{os.getuid()}.sock")
+
+# Jobs share the stage modules, the metrics and the journal, so they run one at a time
+_job_lock = threading.Lock()
+
+# Function to load everything the stages keep between runs: the SpaCy model,
+# its lexicon and the compiled words dictionary
+def warm_up():
+    start_time = time.time()
+    shared_nlp.get_nlp()
+    lexicon.get_known_words()
+    if os.path.exists(replace_words.json_file):
+        replace_words.get_matcher(replace_words.json_file)
+    logging.info(f"Loaded the models and dictionaries in {time.time() - start_time:.2f} seconds")
+
+# Function to take the text of a chapter through every chapter stage, reporting
+# the end of every stage. Returns the final text with the log entries and
+# changes of every stage.
+def run_chapter_job(request, send):
+    chapter_name = request.get('name', 'chapter.txt')
+    text = request['text']
+    stages = []
+    for subdirectory, module in pipeline.chapter_stages:
+        start_time = time.time()
+        results = pipeline.process_chapters(subdirectory, module, {chapter_name: text})
+        if chapter_name not in results:
+            # The stage failed on the chapter, which goes on with its text unchanged
+            send({'event': 'progress', 'stage': subdirectory, 'error': "Stage failed, see the daemon log"})
+            continue
+        text, log_entries, changes = results[chapter_name]
+        stages.append({'stage': subdirectory, 'log_entries': pipeline.stage_log_lines(subdirectory, log_entries),
+                       'changes': changes})
+        send({'event': 'progress', 'stage': subdirectory, 'seconds': time.time() - start_time})
+    return {'text': text, 'stages': stages}
+
+# Function to take a book directory through the whole pipeline, reporting the end of every stage
+def run_book_job(request, send):
+    output_directory = request['output_directory']
+    cache_directory = os.path.join(output_directory, '.build_cache') if request.get('cache', True) else None
+    journal_file = os.path.join(output_directory, 'changes.jsonl')
+    chapters = pipeline.run_pipeline(
+        request['input_directory'], output_directory, request.get('keep_intermediates', False),
+        cache_directory=cache_directory, journal_file=journal_file, write_chapter_logs=False,
+        stage_done=lambda subdirectory: send({'event': 'progress', 'stage': subdirectory}))
+    return {'chapters': sorted(chapters), 'output_directory': output_directory, 'journal_file': journal_file}
+
+# Jobs the daemon runs, by name
+jobs = {
+    'chapter': run_chapter_job,
+    'book': run_book_job,
+}
+
+# Fields every job needs in its request, all of them strings
+job_fields = {
+    'chapter': ['text'],
+    'book': ['input_directory', 'output_directory'],
+}
+
+# Handler of one connection: reads one request as a JSON line and answers with
+# JSON lines, the progress of the job followed by its result or error
+class JobHandler(socketserver.StreamRequestHandler):
+    def send(self, message):
+        self.wfile.write((json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError as e:
+            self.send({'event': 'error', 'error': f"Invalid request: {e}"})
+            return
+        if not isinstance(request, dict):
+            self.send({'event': 'error', 'error': "Invalid request: expected a JSON object"})
+            return
+        job = request.get('job')
+
+        if job == 'ping':
+            self.send({'event': 'result', 'pid': os.getpid()})
+            return
+        if job == 'shutdown':
+            self.send({'event': 'result'})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if not isinstance(job, str) or job not in jobs:
+            self.send({'event': 'error', 'error': f"Unknown job: {job}"})
+            return
+        invalid_fields = [field for field in job_fields[job] if not isinstance(request.get(field), str)]
+        if invalid_fields:
+            self.send({'event': 'error', 'error': f"Invalid request: a {job} job needs the string fields "
+                                                  f"{', '.join(invalid_fields)}"})
+            return
+
+        with _job_lock:
+            metrics.reset()
+            start_time = time.time()
+            try:
+                result = jobs[job](request, self.send)
+            except Exception as e:
+                logging.exception(f"Error running a {job} job")
+                self.send({'event': 'error', 'error': f"{type(e).__name__}: {e}"})
+                return
+            result['seconds'] = time.time() - start_time
+            self.send({'event': 'result', **result})
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Function to serve jobs on a Unix socket until a shutdown job comes in
+def serve(socket_path=default_socket_path):
+    warm_up()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with JobServer(socket_path, JobHandler) as server:
+        logging.info(f"Serving pipeline jobs on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+# Function to send a request to the daemon, yielding every message it answers with
+def request_job(request, socket_path=default_socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode('utf-8'))
+        with client.makefile('r', encoding='utf-8') as answers:
+            for line in answers:
+                yield json.loads(line)
+
+# Function to run a job on the daemon, printing its progress, and return its result
+def run_job(request, socket_path=default_socket_path):
+    for message in request_job(request, socket_path):
+        if message['event'] == 'progress':
+            details = f"failed: {message['error']}" if 'error' in message else "done"
+            print(f"{message['stage']}: {details}", file=sys.stderr)
+        elif message['event'] == 'error':
+            raise RuntimeError(message['error'])
+        elif message['event'] == 'result':
+            return message
+    raise RuntimeError("The daemon closed the connection without a result")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Keep the Atlas pipeline loaded and run jobs sent over a Unix socket.")
+    parser.add_argument("--socket", default=default_socket_path, help="Unix socket the daemon listens on")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("serve", help="start the daemon")
+    chapter_parser = commands.add_parser("chapter", help="run every chapter stage on a chapter file")
+    chapter_parser.add_argument("input_file", help="chapter to process")
+    chapter_parser.add_argument("--output", help="file to write the processed chapter to, standard output by default")
+    book_parser = commands.add_parser("book", help="run the whole pipeline on a book directory")
+    book_parser.add_argument("input_directory", help="directory holding the .txt files of the book")
+    book_parser.add_argument("output_directory", help="directory the outputs of the book are written to")
+    book_parser.add_argument("--keep-intermediates", action="store_true",
+                             help="write the output of every stage for debugging")
+    book_parser.add_argument("--no-cache", action="store_true", help="reprocess every chapter through every stage")
+    commands.add_parser("ping", help="check the daemon is running")
+    commands.add_parser("stop", help="stop the daemon")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == "serve":
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        serve(args.socket)
+    elif args.command == "chapter":
+        with open(args.input_file, 'r', encoding='utf-8') as file:
+            text = file.read()
+        result = run_job({'job': 'chapter', 'name': os.path.basename(args.input_file), 'text': text}, args.socket)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                file.write(result['text'])
+        else:
+            sys.stdout.write(result['text'])
+        print(f"Processed in {result['seconds']:.2f} seconds", file=sys.stderr)
+    elif args.command == "book":
+        result = run_job({'job': 'book', 'input_directory': os.path.abspath(args.input_directory),
+                          'output_directory': os.path.abspath(args.output_directory),
+                          'keep_intermediates': args.keep_intermediates, 'cache': not args.no_cache}, args.socket)
+        print(f"Processed {len(result['chapters'])} chapters into {result['output_directory']} "
+              f"in {result['seconds']:.2f} seconds")
+    elif args.command == "ping":
+        print(f"Daemon running with pid {run_job({'job': 'ping'}, args.socket)['pid']}")
+    elif args.command == "stop":
+        run_job({'job': 'shutdown'}, args.socket)
+        print("Daemon stopped")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
-import spacy
 
+import journal
+import metrics
+import shared_nlp
 from config import base_dir  # Import the base directory
 
 # Directory paths
@@ -9,65 +11,162 @@ input_dir = os.path.join(base_dir, 'txt_processed/6-#@%_added_for_liasons')
 output_dir = os.path.join(base_dir, 'txt_processed/6-5-es_ait_')
 log_dir = os.path.join(output_dir, "logs")
 
-# Load the SpaCy French large model
-nlp = spacy.load("fr_core_news_lg")
+# SpaCy components the stage reads: the tags and morphology of the tokens
+spacy_components = ['morphologizer', 'attribute_ruler']
 
-# Ensure output and log directories exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+def process_text(text):
+    return next(process_texts([text], n_process=1))
 
-def process_file(file_path, output_path, log_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        text = file.read()
-    
-    doc = nlp(text)
-    
-    es_replacements = 0
-    er_replacements = 0
-    ent_replacements = 0
-    aient_replacements = 0
-    
-    es_replaced_words = []
-    er_replaced_words = []
-    ent_replaced_words = []
-    aient_replaced_words = []
-    
-    new_text = []
-    for i, token in enumerate(doc):
-        if (token.tag_ == 'NOUN' and 'Number=Plur' in token.morph and token.text.endswith('es')
-              and token.text.lower() != 'es'):
-            next_token = doc[i + 1] if i < len(doc) - 1 else None
-            if next_token and next_token.text[0].lower() not in 'aeiouà':
-                new_word = token.text[:-1]
-                new_text.append(new_word + token.whitespace_)
-                es_replacements += 1
-                es_replaced_words.append((token.text, new_word))
-            else:
-                new_text.append(token.text_with_ws)
-        elif token.tag_ == 'VERB' and token.text.endswith('er'):
-            new_word = token.text[:-2] + 'é'
-            new_text.append(new_word + token.whitespace_)
-            er_replacements += 1
-            er_replaced_words.append((token.text, new_word))
-        elif (token.tag_ == 'VERB' and 'Number=Plur' in token.morph and 'Person=3' in token.morph
-              and token.text.endswith('aient')):
-            new_word = token.text[:-3]  # Remove 'ent'
-            new_text.append(new_word + token.whitespace_)
-            aient_replacements += 1
-            aient_replaced_words.append((token.text, new_word))
-        elif (token.tag_ == 'VERB' and 'Number=Plur' in token.morph and 'Person=3' in token.morph
-              and token.text.endswith('ent')):
-            new_word = token.text[:-2]
-            new_text.append(new_word + token.whitespace_)
-            ent_replacements += 1
-            ent_replaced_words.append((token.text, new_word))
+# Function to run the stage on a stream of chapters, batched through nlp.pipe,
+# the long chapters chunk by chunk
+def process_texts(texts, batch_size=None, n_process=None):
+    for text, doc in shared_nlp.parse_stream(texts, batch_size, n_process, spacy_components):
+        if doc is not None:
+            yield replace_endings_in_doc(doc)
         else:
-            new_text.append(token.text_with_ws)
-    
-    new_text = "".join(new_text)
+            yield replace_endings_in_chunks(text)
+
+# Kinds of replacements, with the number of letters each one removes from
+# the end of the word and the ending written instead
+ending_replacements = {
+    'es': (1, ''),
+    'er': (2, 'é'),
+    'aient': (3, ''),  # Remove 'ent'
+    'ent': (2, ''),
+}
+ending_kinds = list(ending_replacements)
+
+# Function to evaluate a check once per distinct value of a token attribute, on
+# the first token having the value, and spread the results to every token
+def distinct_value_flags(values, check):
+    import numpy
+
+    _, first_indices, inverse = numpy.unique(values, return_index=True, return_inverse=True)
+    flags = numpy.array([check(index) for index in first_indices.tolist()], dtype=bool)
+    return flags.reshape(len(first_indices), -1)[inverse.reshape(-1)]
+
+# Function to describe the ending of a word: plural noun ending, infinitive,
+# imperfect and present plural verb endings, and whether the word starts with a vowel
+def word_ending_flags(word):
+    return (word.endswith('es') and word.lower() != 'es', word.endswith('er'), word.endswith('aient'),
+            word.endswith('ent'), word[0].lower() in 'aeiouà')
+
+# Function to find the kind of replacement of every token, as an index in
+# ending_kinds plus one, or 0 for the tokens left as they are. The token
+# attributes are pulled in bulk and the words and morphologies are only
+# checked once per distinct value.
+def find_ending_replacements(doc):
+    import numpy
+    from spacy.attrs import ORTH, TAG, MORPH
+
+    if len(doc) == 0:
+        return numpy.zeros(0, dtype=numpy.int8)
+
+    attributes = doc.to_array([ORTH, TAG, MORPH])
+    word_flags = distinct_value_flags(attributes[:, 0], lambda index: word_ending_flags(doc[index].text))
+    morph_flags = distinct_value_flags(
+        attributes[:, 2], lambda index: ('Number=Plur' in doc[index].morph, 'Person=3' in doc[index].morph))
+    nouns = attributes[:, 1] == doc.vocab.strings['NOUN']
+    verbs = attributes[:, 1] == doc.vocab.strings['VERB']
+
+    # Plural nouns ending in 'es' lose their 's' unless the next word starts with a vowel
+    plural_nouns = nouns & morph_flags[:, 0] & word_flags[:, 0]
+    before_consonant = numpy.append(~word_flags[1:, 4], False)
+    plural_verbs = verbs & morph_flags[:, 0] & morph_flags[:, 1]
+
+    kinds = numpy.zeros(len(doc), dtype=numpy.int8)
+    kinds[plural_verbs & word_flags[:, 3]] = ending_kinds.index('ent') + 1
+    kinds[plural_verbs & word_flags[:, 2]] = ending_kinds.index('aient') + 1
+    kinds[verbs & word_flags[:, 1]] = ending_kinds.index('er') + 1
+    kinds[plural_nouns] = 0
+    kinds[plural_nouns & before_consonant] = ending_kinds.index('es') + 1
+    return kinds
+
+# Function to replace the plural and infinitive endings of a parsed text
+def replace_endings_in_doc(doc):
+    new_text, replaced_words = replace_endings_in_span(doc, 0, len(doc.text))[0]
+    return new_text, format_log(replaced_words)
+
+# Function to replace the plural and infinitive endings of a long text, chunk by chunk
+def replace_endings_in_chunks(text):
+    pieces = []
+    replaced_words = {kind: [] for kind in ending_kinds}
+    for piece, chunk_replaced_words in shared_nlp.map_chunks(text, replace_endings_in_span, spacy_components):
+        pieces.append(piece)
+        for kind in ending_kinds:
+            replaced_words[kind].extend(chunk_replaced_words[kind])
+    return "".join(pieces), format_log(replaced_words)
+
+# Function to replace the plural and infinitive endings in the part of a
+# parsed text between two characters, rebuilding the text only around the
+# replaced words. Returns the new text of the part and the words replaced by
+# kind, with the end of the part.
+def replace_endings_in_span(doc, start, end):
+    import numpy
 
+    replaced_words = {kind: [] for kind in ending_kinds}
+
+    kinds = find_ending_replacements(doc)
+    text = doc.text
+    new_text = []
+    position = start
+    tokens = shared_nlp.token_range(doc, start, end)
+    for i in (tokens.start + numpy.flatnonzero(kinds[tokens.start:tokens.stop])).tolist():
+        kind = ending_kinds[kinds[i] - 1]
+        removed, ending = ending_replacements[kind]
+        token = doc[i]
+        new_word = token.text[:-removed] + ending
+        replaced_words[kind].append((token.text, new_word))
+        journal.add(token.idx, token.text, new_word)
+
+        new_text.append(text[position:token.idx])
+        new_text.append(new_word)
+        position = token.idx + len(token.text)
+    new_text.append(text[position:end])
+    return ("".join(new_text), replaced_words), end
+
+# Function to count the replacements of a chapter and build its log entries
+def format_log(replaced_words):
+    es_replaced_words = replaced_words['es']
+    er_replaced_words = replaced_words['er']
+    aient_replaced_words = replaced_words['aient']
+    ent_replaced_words = replaced_words['ent']
+    es_replacements = len(es_replaced_words)
+    er_replacements = len(er_replaced_words)
+    aient_replacements = len(aient_replaced_words)
+    ent_replacements = len(ent_replaced_words)
+
+    metrics.add_replacements({'es': es_replacements, 'er': er_replacements,
+                              'aient': aient_replacements, 'ent': ent_replacements})
+
+    # Build the log entries
+    log_entries = []
+    log_entries.append(f"Total 'es' replacements: {es_replacements}")
+    log_entries.append("Replacements made for 'es':")
+    for original, new in es_replaced_words:
+        log_entries.append(f"Replaced '{original}' with '{new}'")
+
+    log_entries.append("")
+    log_entries.append(f"Total 'er' replacements: {er_replacements}")
+    log_entries.append("Replacements made for 'er':")
+    for original, new in er_replaced_words:
+        log_entries.append(f"Replaced '{original}' with '{new}'")
+
+    log_entries.append("")
+    log_entries.append(f"Total 'aient' replacements: {aient_replacements}")
+    log_entries.append("Replacements made for 'aient':")
+    for original, new in aient_replaced_words:
+        log_entries.append(f"Replaced '{original}' with '{new}'")
+
+    log_entries.append("")
+    log_entries.append(f"Total 'ent' replacements: {ent_replacements}")
+    log_entries.append("Replacements made for 'ent':")
+    for original, new in ent_replaced_words:
+        log_entries.append(f"Replaced '{original}' with '{new}'")
+
+    return log_entries
+
+def write_outputs(file_path, output_path, log_path, new_text, log_entries):
     # Write the processed text to the output file
     with open(output_path, 'w', encoding='utf-8') as output_file:
         output_file.write(new_text)
@@ -75,31 +174,31 @@ def process_file(file_path, output_path, log_path):
     # Write the log file
     with open(log_path, 'w', encoding='utf-8') as log_file:
         log_file.write(f"File: {file_path}\n")
-        log_file.write(f"Total 'es' replacements: {es_replacements}\n")
-        log_file.write("Replacements made for 'es':\n")
-        for original, new in es_replaced_words:
-            log_file.write(f"Replaced '{original}' with '{new}'\n")
-        
-        log_file.write(f"\nTotal 'er' replacements: {er_replacements}\n")
-        log_file.write("Replacements made for 'er':\n")
-        for original, new in er_replaced_words:
-            log_file.write(f"Replaced '{original}' with '{new}'\n")
-        
-        log_file.write(f"\nTotal 'aient' replacements: {aient_replacements}\n")
-        log_file.write("Replacements made for 'aient':\n")
-        for original, new in aient_replaced_words:
-            log_file.write(f"Replaced '{original}' with '{new}'\n")
-        
-        log_file.write(f"\nTotal 'ent' replacements: {ent_replacements}\n")
-        log_file.write("Replacements made for 'ent':\n")
-        for original, new in ent_replaced_words:
-            log_file.write(f"Replaced '{original}' with '{new}'\n")
-
-for filename in os.listdir(input_dir):
-    if filename.endswith('.txt'):
-        input_path = os.path.join(input_dir, filename)
-        output_path = os.path.join(output_dir, filename)
-        log_path = os.path.join(log_dir, f"{os.path.splitext(filename)[0]}_log.txt")
-        process_file(input_path, output_path, log_path)
-
-print("Processing complete.")
+        for entry in log_entries:
+            log_file.write(f"{entry}\n")
+
+def process_file(file_path, output_path, log_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+
+    new_text, log_entries = process_text(text)
+    write_outputs(file_path, output_path, log_path, new_text, log_entries)
+
+# Function to process a batch of files as one stream of chapters
+def process_files(file_paths, output_paths, log_paths, batch_size=None, n_process=None):
+    texts = shared_nlp.read_text_files(file_paths)
+    results = process_texts(texts, batch_size, n_process)
+    for file_path, output_path, log_path, (new_text, log_entries) in zip(file_paths, output_paths, log_paths, results):
+        write_outputs(file_path, output_path, log_path, new_text, log_entries)
+
+if __name__ == "__main__":
+    # Ensure output and log directories exist
+    os.makedirs(log_dir, exist_ok=True)
+
+    filenames = [filename for filename in os.listdir(input_dir) if filename.endswith('.txt')]
+    input_paths = [os.path.join(input_dir, filename) for filename in filenames]
+    output_paths = [os.path.join(output_dir, filename) for filename in filenames]
+    log_paths = [os.path.join(log_dir, f"{os.path.splitext(filename)[0]}_log.txt") for filename in filenames]
+    process_files(input_paths, output_paths, log_paths)
+
+    print("Processing complete.")
@@ -1,29 +1,17 @@
 #!/usr/bin/env python3
 import os
 import re
-import spacy
 import logging
+import itertools
+import lexicon
+import journal
+import metrics
+import shared_nlp
 from config import base_dir  # Import the base directory
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
-
-# Load the SpaCy French large model
-try:
-    nlp = spacy.load("fr_core_news_lg")
-except Exception as e:
-    logging.error(f"Error loading SpaCy model: {e}")
-    raise
-
-# Define the input and output directories
-input_dir = os.path.join(base_dir, 'txt_processed/4-numbers_replaced')
-output_dir = os.path.join(base_dir, 'txt_processed/5-line-fix')
-logs_dir = os.path.join(output_dir, 'logs')
-
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-if not os.path.exists(logs_dir):
-    os.makedirs(logs_dir)
+# SpaCy components the stage reads: the entity types, besides the lexical
+# attributes the tokenizer sets
+spacy_components = ['ner']
 
 # Function to add break times after titles
 def add_break_times(text):
@@ -42,71 +30,328 @@ def add_break_times(text):
     # Ensure the text ends with a break
     new_lines.append('<break time="2.5s" />')
 
+    if journal.is_recording():
+        journal_break_times(text)
     return "\n".join(new_lines)
 
-# Function to check if a word is valid using SpaCy
+# Function to record the changes add_break_times makes to a text: the breaks
+# added, and the line endings written as a single line break
+def journal_break_times(text):
+    lines = text.splitlines(keepends=True)
+    if not lines:
+        journal.add(0, '', '<break time="0.5s" />\n<break time="2.5s" />')
+        return
+
+    journal.add(0, '', '<break time="0.5s" />\n')
+    offset = 0
+    for i, (line, line_text) in enumerate(zip(lines, text.splitlines())):
+        new_ending = " <break time=\"2.0s\" />" if i == 1 else ''
+        new_ending += '\n' if i < len(lines) - 1 else '\n<break time="2.5s" />'
+        if line[len(line_text):] != new_ending:
+            journal.add(offset + len(line_text), line[len(line_text):], new_ending)
+        offset += len(line)
+
+# Function to check if a word is valid using the lexicon of the SpaCy model
 def is_valid_word(word):
-    doc = nlp(word)
-    return len(doc) == 1 and doc[0].is_alpha
+    return lexicon.is_valid_word(word)
 
-# Function to remove hyphens that break words at the end of lines
-def fix_broken_hyphens(text):
-    corrected_text = []
-    changes = []
+# Lower case letters a word broken across two lines ends and starts with
+lowercase_letters = 'a-zàâçéèêëîïôûùüÿñæœ'
 
-    lines = text.splitlines()
+# Word broken by a hyphen at the end of a line whose second part starts in
+# lower case, past any blank lines, merged by every pass of the repair
+broken_word_pattern = re.compile(f'([{lowercase_letters},;])-\\s*\\n\\s*([{lowercase_letters}])')
+
+# Function to map ranges of a text made of pieces of another text, given as
+# ranges of it, to the ranges of the other text they cover
+def map_ranges(pieces, ranges):
+    mapped = []
+    piece_index = 0
+    piece_offset = 0
+    for start, end in ranges:
+        while start < end:
+            piece_start, piece_end = pieces[piece_index]
+            if piece_offset + piece_end - piece_start <= start:
+                piece_offset += piece_end - piece_start
+                piece_index += 1
+                continue
+            mapped_start = piece_start + start - piece_offset
+            mapped_end = min(piece_end, piece_start + end - piece_offset)
+            if mapped and mapped[-1][1] == mapped_start:
+                mapped[-1] = (mapped[-1][0], mapped_end)
+            else:
+                mapped.append((mapped_start, mapped_end))
+            start += mapped_end - mapped_start
+    return mapped
+
+# Function to run one pass of the hyphen repair of the old scans on a chain of
+# broken lines: every line ending with a known word broken by a hyphen is
+# merged with the next line, even a blank one, the merged line only being
+# checked again by the next pass, then the words whose second part starts in
+# lower case are merged. Returns the repaired text with the ranges of the
+# text it is made of.
+def repair_chain_pass(text, changes):
+    lines = text.split('\n')
+    line_starts = list(itertools.accumulate((len(line) + 1 for line in lines), initial=0))
+
+    # Ranges of the text kept by the merges of known words
+    kept = []
     i = 0
     while i < len(lines):
         line = lines[i].rstrip()
+        if i > 0:
+            kept.append((line_starts[i] - 1, line_starts[i]))
+        kept_line = (line_starts[i], line_starts[i] + len(line))
         if line.endswith('-') and i + 1 < len(lines):
-            next_line = lines[i + 1].lstrip()
             last_word = line.split()[-1]
             parts = last_word.split('-')
-            if len(parts) == 2:
-                before, after = parts
-                combined_word = before + after
-                if is_valid_word(combined_word):
-                    changes.append(f"Removed hyphen in: {last_word} -> {combined_word}")
-                    # Remove the hyphen and merge the lines correctly
-                    line = line[:-len(last_word)] + combined_word + next_line[len(after):].lstrip()
-                    i += 1  # Skip the next line as it has been merged
-        corrected_text.append(line)
+            if len(parts) == 2 and is_valid_word(parts[0] + parts[1]):
+                changes.append(f"Removed hyphen in: {last_word} -> {parts[0] + parts[1]}")
+                next_line = lines[i + 1]
+                kept.append((line_starts[i], line_starts[i] + len(line) - 1))
+                kept_line = (line_starts[i + 1] + len(next_line) - len(next_line.lstrip()),
+                             line_starts[i + 1] + len(next_line))
+                i += 1
+        kept.append(kept_line)
         i += 1
+    merged_text = ''.join(text[start:end] for start, end in kept)
+
+    # Ranges of the merged text kept by the merges of words starting in lower case
+    merged_kept = []
+    last_end = 0
+    for match in broken_word_pattern.finditer(merged_text):
+        merged_kept.append((last_end, match.end(1)))
+        last_end = match.start(2)
+    merged_kept.append((last_end, len(merged_text)))
+    repaired_text = ''.join(merged_text[start:end] for start, end in merged_kept)
+    return repaired_text, map_ranges(kept, merged_kept)
 
-    text = '\n'.join(corrected_text)
+# Function to repair a chain of broken lines, from a line ending with a hyphen
+# to the first line holding text that does not, with passes of the repair
+# until none changes it. A pass drops the empty line ending a chain at the end
+# of the text, as its line break is lost once the lines are joined. Adds the
+# spans of the text the passes removed to deletions, when they are recorded.
+def repair_chain(text, line_spans, changes, deletions=None, at_end=False):
+    chain_text = '\n'.join(text[start:end] for start, end, _ in line_spans)
+    # Ranges of the chain as it was given that the repaired chain is made of
+    pieces = [(0, len(chain_text))]
 
-    # Ensure proper merging of broken words without adding extra spaces
-    text = re.sub(r'([a-zàâçéèêëîïôûùüÿñæœ,;])-\s*\n\s*([a-zàâçéèêëîïôûùüÿñæœ])', r'\1\2', text)
-    return text, changes
+    while True:
+        repaired_text, kept = repair_chain_pass(chain_text, changes)
+        if at_end and repaired_text.endswith('\n'):
+            repaired_text = repaired_text[:-1]
+            kept = map_ranges(kept, [(0, len(repaired_text))])
+        if len(repaired_text) == len(chain_text):
+            break
+        if deletions is not None:
+            pieces = map_ranges(pieces, kept)
+        chain_text = repaired_text
+
+    if deletions is not None:
+        # Offset in the text of every character of the chain as it was given, a
+        # line break standing for the line separator it replaces, and of its end
+        chain_offsets = []
+        for start, end, separator_end in line_spans:
+            chain_offsets.extend(range(start, end))
+            chain_offsets.append(end)
+        chain_offsets[-1] = line_spans[-1][1]
+
+        last_end = 0
+        for start, end in pieces + [(len(chain_offsets) - 1, len(chain_offsets) - 1)]:
+            if last_end < start:
+                deletions.append((chain_offsets[last_end], chain_offsets[start]))
+            last_end = end
+    return chain_text
+
+# Function to record the spans of a text the hyphen repair removed, with the
+# empty lines and line breaks it drops at the end of the text
+def journal_deletions(text, deletions):
+    merged_deletions = []
+    for start, end in sorted(deletions):
+        if merged_deletions and start <= merged_deletions[-1][1]:
+            merged_deletions[-1][1] = max(merged_deletions[-1][1], end)
+        else:
+            merged_deletions.append([start, end])
+
+    # The text ends with the last character kept that is not a space, and
+    # everything after it is removed
+    text_end = len(text.rstrip())
+    for start, end in reversed(merged_deletions):
+        if start < text_end <= end:
+            text_end = len(text[:start].rstrip())
+    merged_deletions = [deletion for deletion in merged_deletions if deletion[0] < text_end]
+    if text_end < len(text):
+        merged_deletions.append([text_end, len(text)])
+
+    for start, end in merged_deletions:
+        journal.add(start, text[start:end], '')
+
+# Function to remove hyphens that break words at the end of lines, giving the
+# text repeating the repair of the old three scans would settle on. A known
+# word broken by a hyphen is merged with the next line, taking in a blank one
+# as is, and a word whose second part starts in lower case with the next line
+# holding text. The lines between two chains of broken lines are only stripped,
+# and every chain is repaired on its own, with passes over its lines alone.
+def fix_broken_hyphens(text):
+    corrected_text = []
+    changes = []
+
+    # Every line as the start and end of its text and the end of its separator
+    line_spans = []
+    line_start = 0
+    for line in text.splitlines(keepends=True):
+        line_spans.append((line_start, line_start + len(line.splitlines()[0]), line_start + len(line)))
+        line_start += len(line)
+    deletions = [] if journal.is_recording() else None
+
+    def line_text(index):
+        return text[line_spans[index][0]:line_spans[index][1]]
+
+    i = 0
+    while i < len(line_spans):
+        start, end, _ = line_spans[i]
+        line = line_text(i).rstrip()
+
+        # Lines of the chain starting with the line, up to the first line
+        # holding text that does not end with a hyphen
+        last_index = i
+        while line.endswith('-') and last_index + 1 < len(line_spans):
+            last_index += 1
+            while last_index + 1 < len(line_spans) and not line_text(last_index).strip():
+                last_index += 1
+            line = line_text(last_index).rstrip()
+
+        if last_index > i:
+            corrected_text.extend(repair_chain(text, line_spans[i:last_index + 1], changes, deletions,
+                                                at_end=last_index + 1 == len(line_spans)).split('\n'))
+        else:
+            if deletions is not None and len(line) < end - start:
+                deletions.append((start + len(line), end))
+            corrected_text.append(line)
+        i = last_index + 1
+
+    # Joining the lines drops the line break after an empty last line, so
+    # repeating the repair removes every empty line at the end of the text
+    while corrected_text and not corrected_text[-1]:
+        corrected_text.pop()
+
+    if deletions is not None:
+        journal_deletions(text, deletions)
+    return '\n'.join(corrected_text), changes
 
 # Function to handle the removal of unwanted spaces between paragraphs
 def fix_paragraph_spaces(text):
-    # Tokenize the text using SpaCy
-    doc = nlp(text)
-    
+    if shared_nlp.is_chunked(text):
+        return fix_paragraph_spaces_in_chunks(text)
+    # Tokenize the text using the shared SpaCy parse
+    return fix_paragraph_spaces_in_doc(shared_nlp.parse(text, spacy_components))
+
+# Function to handle the removal of unwanted spaces between paragraphs of a parsed text
+def fix_paragraph_spaces_in_doc(doc):
+    return fix_paragraph_spaces_in_span(doc, 0, len(doc.text))[0]
+
+# Function to handle the removal of unwanted spaces between paragraphs of a long text, chunk by chunk
+def fix_paragraph_spaces_in_chunks(text):
+    corrected_text = []
+    changes = []
+    for chunk_text, chunk_changes in shared_nlp.map_chunks(text, fix_paragraph_spaces_in_span, spacy_components):
+        corrected_text.append(chunk_text)
+        changes.extend(chunk_changes)
+    return "".join(corrected_text), changes
+
+# Function to handle the removal of unwanted spaces between paragraphs in the
+# part of a parsed text between two characters. The two tokens after the last
+# one may lie past the end. Returns the corrected text of the part and its
+# changes, with the character the part ended at, past the end when the last
+# merge took in tokens after it.
+def fix_paragraph_spaces_in_span(doc, start, end):
     # Initialize corrected text and change log
     corrected_text = []
     changes = []
-    
-    i = 0
-    while i < len(doc):
+
+    tokens = shared_nlp.token_range(doc, start, end)
+    i = tokens.start
+    while i < tokens.stop:
         token = doc[i]
         if token.is_alpha and token.is_lower and i + 2 < len(doc) and doc[i + 1].is_space and doc[i + 2].ent_type_ == 'PER':
             # Merge current token with the next if the next is a proper noun
             corrected_text.append(token.text + " " + doc[i + 2].text)
             changes.append(f"Merged: {token.text} {doc[i + 2].text}")
+            end_offset = doc[i + 2].idx + len(doc[i + 2].text_with_ws)
+            journal.add(token.idx, doc.text[token.idx:end_offset], token.text + " " + doc[i + 2].text)
             i += 3  # Skip the space and the proper noun
         else:
             corrected_text.append(token.text_with_ws)
             i += 1
 
-    return "".join(corrected_text), changes
+    metrics.add_replacements({'paragraph_merges': len(changes)})
+    stop = doc[i].idx if i < len(doc) else len(doc.text)
+    return ("".join(corrected_text), changes), max(stop, end)
+
+# Line breaks between a sentence ending with lowercase and one starting with lowercase
+sentence_break_pattern = re.compile(r'([a-zàâçéèêëîïôûùüÿñæœ,])\s*\n\s*([a-zàâçéèêëîïôûùüÿñæœ])')
 
 # Function to handle spaces between sentences ending with lowercase and starting with lowercase
 def merge_sentences(text):
-    text = re.sub(r'([a-zàâçéèêëîïôûùüÿñæœ,])\s*\n\s*([a-zàâçéèêëîïôûùüÿñæœ])', r'\1 \2', text)
+    if journal.is_recording():
+        for match in sentence_break_pattern.finditer(text):
+            journal.add(match.start(), match.group(), match.expand(r'\1 \2'))
+    text = sentence_break_pattern.sub(r'\1 \2', text)
     return text
 
+# Function to run the line fixes that come before the SpaCy parse
+def fix_line_breaks(text):
+    with journal.steps() as step:
+        # Add break times first
+        with step():
+            text_with_breaks = add_break_times(text)
+
+        # Fix broken hyphens and merge lines
+        with step():
+            corrected_text, changes = fix_broken_hyphens(text_with_breaks)
+
+    metrics.add_replacements({'hyphens': len(changes)})
+    return corrected_text, changes
+
+# Function to run all line fixes on the text of a chapter
+def process_text(text):
+    return next(process_texts([text], n_process=1))
+
+# Function to run all line fixes on a stream of chapters, batching the SpaCy parse through nlp.pipe
+def process_texts(texts, batch_size=None, n_process=None):
+    pending_changes = []
+
+    # Changes made before the parse are kept with the text until its output is
+    # handed out, as the parse reads ahead of the chapter being handed out.
+    # Every step is recorded on the text it works on, and the journal gets
+    # them all at their offsets in the chapter.
+    def fixed_texts():
+        for text in texts:
+            with journal.recording() as line_changes:
+                corrected_text, changes = fix_line_breaks(text)
+            pending_changes.append((changes, line_changes))
+            yield corrected_text
+
+    for text, doc in shared_nlp.parse_stream(fixed_texts(), batch_size, n_process, spacy_components):
+        changes, line_changes = pending_changes.pop(0)
+        with journal.steps() as step:
+            with step():
+                journal.extend(line_changes)
+
+            # Fix paragraph spaces and merge lines with proper nouns, the long chapters chunk by chunk
+            with step():
+                if doc is not None:
+                    corrected_text, space_changes = fix_paragraph_spaces_in_doc(doc)
+                else:
+                    corrected_text, space_changes = fix_paragraph_spaces_in_chunks(text)
+            changes.extend(space_changes)
+
+            # Merge sentences where needed
+            with step():
+                final_text = merge_sentences(corrected_text)
+
+        yield final_text, changes
+
 def process_directory(input_dir, output_dir, logs_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -123,24 +368,7 @@ def process_directory(input_dir, output_dir, logs_dir):
             with open(input_path, "r", encoding="utf-8") as file:
                 text = file.read()
 
-            # Add break times first
-            text_with_breaks = add_break_times(text)
-
-            # First scan to fix broken hyphens and merge lines
-            corrected_text, changes = fix_broken_hyphens(text_with_breaks)
-            # Second scan to ensure all cases are handled
-            corrected_text, new_changes = fix_broken_hyphens(corrected_text)
-            changes.extend(new_changes)
-            # Third scan for any remaining cases
-            corrected_text, more_changes = fix_broken_hyphens(corrected_text)
-            changes.extend(more_changes)
-
-            # Fix paragraph spaces and merge lines with proper nouns
-            corrected_text, space_changes = fix_paragraph_spaces(corrected_text)
-            changes.extend(space_changes)
-
-            # Merge sentences where needed
-            final_text = merge_sentences(corrected_text)
+            final_text, changes = process_text(text)
 
             with open(output_path, "w", encoding="utf-8") as file:
                 file.write(final_text)
@@ -159,6 +387,9 @@ def process_directory(input_dir, output_dir, logs_dir):
         logging.info(f"Processed {file_count} files")
 
 if __name__ == "__main__":
+    # Set up logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
     input_dir = os.path.join(base_dir, 'txt_processed/4-numbers_replaced')
     output_dir = os.path.join(base_dir, 'txt_processed/5-line-fix')
     logs_dir = os.path.join(output_dir, 'logs')
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+import os
+import json
+import queue
+import argparse
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Changes of the text being processed, as (offset, old, new), or None when
+# they are not recorded. Kept per thread, as a pipelined run processes several
+# chapters at once.
+_state = threading.local()
+
+# Queue of the changes waiting for the background writer, and the writer thread
+_queue = None
+_writer = None
+
+# Function to tell whether the changes of the text being processed are recorded,
+# so the stages only work the offsets out when they are needed
+def is_recording():
+    return getattr(_state, 'changes', None) is not None
+
+# Function to record a change of the text being processed: the old value found
+# at an offset of the text replaced by the new one
+def add(offset, old, new):
+    changes = getattr(_state, 'changes', None)
+    if changes is not None:
+        changes.append((getattr(_state, 'offset', 0) + offset, old, new))
+
+# Function to record changes collected earlier, like the ones made before a batched SpaCy parse
+def extend(changes):
+    recorded_changes = getattr(_state, 'changes', None)
+    if recorded_changes is not None:
+        offset = getattr(_state, 'offset', 0)
+        recorded_changes.extend((offset + change_offset, old, new) for change_offset, old, new in changes)
+
+# Function to collect the changes recorded inside a block of code into a list,
+# at their offsets in the text the block works on
+@contextmanager
+def recording():
+    previous_changes = getattr(_state, 'changes', None)
+    previous_offset = getattr(_state, 'offset', 0)
+    _state.changes = changes = []
+    _state.offset = 0
+    try:
+        yield changes
+    finally:
+        _state.changes = previous_changes
+        _state.offset = previous_offset
+
+# Function to record the changes of a stage made in several steps, each step
+# working on the text left by the ones before it. Gives a function opening the
+# block of code of a step, and records the changes of all the steps at their
+# offsets in the text given to the first one.
+@contextmanager
+def steps():
+    if not is_recording():
+        yield nullcontext
+        return
+
+    combined_changes = []
+
+    @contextmanager
+    def step():
+        nonlocal combined_changes
+        with recording() as changes:
+            yield
+        combined_changes = compose(combined_changes, changes)
+
+    yield step
+    extend(combined_changes)
+
+# Function to move the offsets of the changes recorded inside a block of code,
+# for the stages working on a part of the text starting at the given offset
+@contextmanager
+def shifted(offset):
+    previous_offset = getattr(_state, 'offset', 0)
+    _state.offset = previous_offset + offset
+    try:
+        yield
+    finally:
+        _state.offset = previous_offset
+
+# Function to combine the changes made to a text with the changes then made to
+# the changed text, into changes of the first text. Both lists are given in the
+# order of their offsets, and changes touching the same characters are merged.
+def compose(changes, later_changes):
+    if not changes:
+        return list(later_changes)
+    if not later_changes:
+        return list(changes)
+
+    # Every change as (start, end, is_later, old, new), start and end being its
+    # place in the text between the two lists of changes
+    items = []
+    shift = 0
+    for offset, old, new in changes:
+        items.append((offset + shift, offset + shift + len(new), False, old, new))
+        shift += len(new) - len(old)
+    for offset, old, new in later_changes:
+        items.append((offset, offset + len(old), True, old, new))
+    items.sort(key=lambda item: (item[0], item[1], item[2]))
+
+    composed = []
+    shift = 0
+    position = 0
+    while position < len(items):
+        group = [items[position]]
+        group_start, group_end = items[position][0], items[position][1]
+        position += 1
+        while position < len(items) and items[position][0] < group_end:
+            group.append(items[position])
+            group_end = max(group_end, items[position][1])
+            position += 1
+
+        earlier = [item for item in group if not item[2]]
+        later = [item for item in group if item[2]]
+        old_parts = []
+        new_parts = []
+        if not later:
+            old_parts.append(earlier[0][3])
+            new_parts.append(earlier[0][4])
+        elif not earlier:
+            old_parts.append(later[0][3])
+            new_parts.append(later[0][4])
+        else:
+            # The text of the group between the two lists of changes, pieced
+            # together from the new values of the earlier changes and the old
+            # values of the later ones
+            middle = [None] * (group_end - group_start)
+            for start, end, is_later, old, new in group:
+                middle[start - group_start:end - group_start] = new if not is_later else old
+            for parts, chosen in ((old_parts, earlier), (new_parts, later)):
+                index = group_start
+                for start, end, is_later, old, new in chosen:
+                    parts.extend(middle[index - group_start:start - group_start])
+                    parts.append(old if not is_later else new)
+                    index = end
+                parts.extend(middle[index - group_start:])
+
+        old = "".join(old_parts)
+        new = "".join(new_parts)
+        if old != new:
+            composed.append((group_start - shift, old, new))
+        shift += sum(len(item[4]) - len(item[3]) for item in earlier)
+    return composed
+
+# Function to format the changes of a stage for a chapter as JSON lines
+def format_records(stage, chapter, changes):
+    return "".join(json.dumps({'stage': stage, 'chapter': chapter, 'offset': offset, 'old': old, 'new': new},
+                              ensure_ascii=False) + "\n"
+                   for offset, old, new in changes)
+
+# Function run by the background writer: takes everything waiting in the queue
+# and writes it in a single call, until the journal is closed
+def _write_journal(file):
+    closed = False
+    while not closed:
+        items = [_queue.get()]
+        while True:
+            try:
+                items.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        lines = []
+        for item in items:
+            if item is None:
+                closed = True
+            else:
+                lines.append(format_records(*item))
+        file.write("".join(lines))
+        file.flush()
+
+# Function to open the journal of a run, written to by a background thread
+def start(file_path):
+    global _queue, _writer
+    if _writer is not None:
+        stop()
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    file = open(file_path, 'w', encoding='utf-8')
+    _queue = queue.Queue()
+
+    def write_and_close():
+        with file:
+            _write_journal(file)
+
+    _writer = threading.Thread(target=write_and_close, name="journal-writer", daemon=True)
+    _writer.start()
+
+# Function to add the changes a stage made to a chapter to the journal, if one is open
+def write(stage, chapter, changes):
+    if _queue is not None and changes:
+        _queue.put((stage, chapter, changes))
+
+# Function to write what is left in the queue and close the journal
+def stop():
+    global _queue, _writer
+    if _writer is None:
+        return
+    _queue.put(None)
+    _writer.join()
+    _queue = None
+    _writer = None
+
+# Function to read the records of a journal
+def read_records(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+# Function to keep the records of a stage and chapter, or whose old or new value holds a text
+def filter_records(records, stage=None, chapter=None, text=None):
+    for record in records:
+        if stage is not None and stage not in record['stage']:
+            continue
+        if chapter is not None and chapter not in record['chapter']:
+            continue
+        if text is not None and text not in record['old'] and text not in record['new']:
+            continue
+        yield record
+
+# Function to count the records by stage and by change
+def summarize(records):
+    stage_counts = Counter()
+    change_counts = Counter()
+    for record in records:
+        stage_counts[record['stage']] += 1
+        change_counts[(record['stage'], record['old'], record['new'])] += 1
+    return stage_counts, change_counts
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Review the changes the pipeline made to the chapters.")
+    parser.add_argument("journal_file", help="journal of a run, as written by main.py")
+    parser.add_argument("--stage", help="only show the stages whose name contains this text")
+    parser.add_argument("--chapter", help="only show the chapters whose name contains this text")
+    parser.add_argument("--text", help="only show the changes whose old or new value contains this text")
+    parser.add_argument("--summary", action="store_true",
+                        help="count the changes by stage and list the most frequent ones")
+    parser.add_argument("--limit", type=int, default=50, help="number of changes or summary lines to show")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    records = filter_records(read_records(args.journal_file), args.stage, args.chapter, args.text)
+
+    if args.summary:
+        stage_counts, change_counts = summarize(records)
+        for stage, count in sorted(stage_counts.items()):
+            print(f"{stage:<28} {count:>9} changes")
+        print()
+        for (stage, old, new), count in change_counts.most_common(args.limit):
+            print(f"{count:>9}  {stage:<28} {old!r} -> {new!r}")
+        return
+
+    for shown, record in enumerate(records):
+        if shown == args.limit:
+            print("...")
+            break
+        print(f"{record['stage']:<28} {record['chapter']:<32} {record['offset']:>9}  {record['old']!r} -> {record['new']!r}")
+
+if __name__ == "__main__":
+    main()
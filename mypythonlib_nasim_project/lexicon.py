@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+import shared_nlp
+
+# Number of words outside the lexicon whose validity is remembered
+unknown_word_cache_size = 100000
+
+_known_words = None
+
+# Function to build the set of valid words from the vocabulary of the SpaCy model
+def get_known_words():
+    global _known_words
+    if _known_words is None:
+        vocab = shared_nlp.get_nlp().vocab
+        words = (vocab.strings[key] for key in vocab.vectors.keys() if key in vocab.strings)
+        _known_words = frozenset(word for word in words if word.isalpha())
+    return _known_words
+
+# Function to check a word the lexicon does not know with the tokenizer alone
+@lru_cache(maxsize=unknown_word_cache_size)
+def is_single_alpha_token(word):
+    doc = shared_nlp.get_nlp().make_doc(word)
+    return len(doc) == 1 and doc[0].is_alpha
+
+# Function to check if a word is valid
+def is_valid_word(word):
+    return word in get_known_words() or is_single_alpha_token(word)
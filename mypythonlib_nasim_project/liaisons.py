@@ -1,22 +1,18 @@
 #!/usr/bin/env python3
-import spacy
 import os
 
+import journal
+import metrics
+import shared_nlp
 from config import base_dir  # Import the base directory
 
-# Load the French language model in SpaCy
-nlp = spacy.load("fr_core_news_lg")
-
 # Directory paths
 input_dir = os.path.join(base_dir, 'txt_processed/5-line-fix')
 output_dir = os.path.join(base_dir, 'txt_processed/6-#@%_added_for_liasons')
 log_dir = os.path.join(output_dir, "logs")
 
-# Ensure output and log directories exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+# SpaCy components the stage reads: the part of speech of the tokens
+spacy_components = ['morphologizer', 'attribute_ruler']
 
 # List of exceptions for liaisons with "s"
 exceptions_s = {
@@ -35,133 +31,194 @@ exceptions_s = {
 
 # Function to identify and replace liaisons
 def identify_and_replace_liaisons(text):
-    doc = nlp(text)
+    return next(identify_and_replace_liaisons_in_texts([text], n_process=1))
+
+# Function to identify and replace the liaisons of a stream of chapters,
+# batched through nlp.pipe, the long chapters chunk by chunk
+def identify_and_replace_liaisons_in_texts(texts, batch_size=None, n_process=None):
+    for text, doc in shared_nlp.parse_stream(texts, batch_size, n_process, spacy_components):
+        if doc is not None:
+            yield replace_liaisons_in_doc(doc)
+        else:
+            yield replace_liaisons_in_chunks(text)
+
+# Liaison rules, in the order they are tried on every token but the last and
+# the token after it. A rule applies when the token is one of 'tokens', or ends
+# with 'token_ends_with', and the next token is one of 'next_tokens', or starts
+# with one of the letters of 'next_starts_with'. Words whose lower case is in
+# 'exceptions' never take part in the rule, and proper nouns never start a
+# liaison. The token is then written as 'word', where {stem} is the token
+# without its last letter and {next_tail} the next token without its first
+# letter. The rule adds one to the 'counter' replacement count and logs the
+# word, or 'logged' when given. A rule that 'joins_next' writes the next token
+# into the word, so the next token is left out of the text.
+liaison_rules = [
+    {'tokens': {"est"}, 'next_tokens': {"un"}, 'word': "ét'un", 'counter': "é'tun", 'joins_next': True},
+    {'tokens': {"est"}, 'next_tokens': {"une"}, 'word': "ét'une", 'counter': "ét'une", 'joins_next': True},
+    {'tokens': {"est"}, 'next_starts_with': 'aeiouhéà', 'word': "é't", 'counter': "é't"},
+    {'tokens': {"c'est"}, 'next_tokens': {"un"}, 'word': "cét'un", 'counter': "cét'un", 'joins_next': True},
+    {'tokens': {"c'est"}, 'next_tokens': {"une"}, 'word': "cét'une", 'counter': "cét'une", 'joins_next': True},
+    {'tokens': {"c'est"}, 'next_starts_with': 'aeiouhéà', 'word': "cé't", 'counter': "cé't"},
+    {'tokens': {"n'est"}, 'next_tokens': {"un"}, 'word': "n'ét'un", 'counter': "n'ét'un", 'joins_next': True},
+    {'tokens': {"n'est"}, 'next_tokens': {"une"}, 'word': "n'ét'une", 'counter': "n'ét'une", 'joins_next': True},
+    {'tokens': {"n'est"}, 'next_starts_with': 'aeiouhéà', 'word': "né't", 'counter': "né't"},
+    # "qu'" + "ils"/"elles"
+    {'tokens': {"qu'"}, 'next_tokens': {"ils", "elles"}, 'word': "qu'#@%{next_tail}", 'counter': "#@%"},
+    # Liaisons with "s" for "ils" and "elles"
+    {'tokens': {"ils", "elles"}, 'next_starts_with': 'aeiouh', 'word': "{stem}#@%", 'counter': "{token}#@%"},
+    # General liaisons with "s"
+    {'token_ends_with': 's', 'next_starts_with': 'aeiouhàé', 'exceptions': exceptions_s,
+     'word': "{stem}#@%", 'counter': "#@%", 'logged': "#@%"},
+]
+
+# Replacement counts of the log, in the order they are listed
+replacement_counters = ["é'tun", "ét'une", "é't", "cét'un", "cét'une", "cé't",
+                        "n'ét'un", "n'ét'une", "né't", "#@%", "ils#@%", "elles#@%"]
+
+# Rules each word can start and end, as bit masks of the rules, by word hash
+_word_rules = {}
+
+# Function to find the rules a word can start, as the token, and end, as the
+# next token, as two bit masks with one bit per rule
+def word_rules(word):
+    token_mask = 0
+    next_mask = 0
+    for index, rule in enumerate(liaison_rules):
+        if word.lower() in rule.get('exceptions', ()):
+            continue
+        if word in rule.get('tokens', ()) or ('token_ends_with' in rule and word.endswith(rule['token_ends_with'])):
+            token_mask |= 1 << index
+        if word in rule.get('next_tokens', ()) or word[:1] in rule.get('next_starts_with', ''):
+            next_mask |= 1 << index
+    return token_mask, next_mask
+
+# Function to find, for every token but the last, the bit mask of the rules it
+# starts with the token after it. The rules are looked up once per distinct
+# word and combined over the whole text with NumPy.
+def match_rules(doc):
+    import numpy
+    from spacy.attrs import ORTH, POS
+    from spacy.parts_of_speech import PROPN
+
+    attributes = doc.to_array([ORTH, POS])
+    words, word_indices = numpy.unique(attributes[:, 0], return_inverse=True)
+    masks = []
+    for word in words.tolist():
+        if word not in _word_rules:
+            _word_rules[word] = word_rules(doc.vocab.strings[word])
+        masks.append(_word_rules[word])
+    masks = numpy.array(masks, dtype=numpy.int64).reshape(-1, 2)[word_indices.reshape(-1)]
+
+    matches = masks[:-1, 0] & masks[1:, 1]
+    matches[attributes[:-1, 1] == PROPN] = 0
+    return matches
+
+# Function to identify and replace liaisons in a parsed text
+def replace_liaisons_in_doc(doc):
+    return replace_liaisons_in_span(doc, 0, len(doc.text))[0]
+
+# Function to identify and replace liaisons in a long text, chunk by chunk
+def replace_liaisons_in_chunks(text):
+    liaisons = []
+    replacements = dict.fromkeys(replacement_counters, 0)
+    pieces = []
+    for chunk_liaisons, piece, chunk_replacements in shared_nlp.map_chunks(text, replace_liaisons_in_span,
+                                                                           spacy_components):
+        liaisons.extend(chunk_liaisons)
+        pieces.append(piece)
+        for counter, count in chunk_replacements.items():
+            replacements[counter] += count
+    return liaisons, ''.join(pieces), replacements
+
+# Function to identify and replace liaisons in the part of a parsed text
+# between two characters, only visiting the tokens some rule matches. The token
+# after the last one may lie past the end. Returns the liaisons, the new text
+# of the part and the replacement counts, with the character the part ended
+# at, past the end when the last liaison took in the token after it.
+def replace_liaisons_in_span(doc, start, end):
+    import numpy
+
     liaisons = []
-    modified_tokens = []
-
-    replacements = {
-        "é'tun": 0,
-        "ét'une": 0,
-        "é't": 0,
-        "cét'un": 0,
-        "cét'une": 0,
-        "cé't": 0,
-        "n'ét'un": 0,
-        "n'ét'une": 0,
-        "né't": 0,
-        "#@%": 0,
-        "ils#@%": 0,
-        "elles#@%": 0
-    }
-
-    i = 0
-    while i < len(doc) - 1:
+    replacements = dict.fromkeys(replacement_counters, 0)
+    text = doc.text
+    pieces = []
+    position = start
+
+    matches = match_rules(doc) if len(doc) else numpy.zeros(0, dtype=numpy.int64)
+    tokens = shared_nlp.token_range(doc, start, end)
+    next_index = tokens.start
+    for i in numpy.flatnonzero(matches[:tokens.stop]).tolist():
+        # Tokens joined into the word of the previous liaison start no liaison
+        if i < next_index:
+            continue
+        mask = int(matches[i])
+        rule = liaison_rules[(mask & -mask).bit_length() - 1]
         token = doc[i]
         next_token = doc[i + 1]
-        word = token.text
-
-        # Skip processing for proper nouns
-        if token.pos_ == 'PROPN':
-            word = token.text
-        # Apply specific rules for "est" first to avoid overlap
-        elif token.text == "est":
-            if next_token.text == "un":
-                word = "ét'un"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["é'tun"] += 1
-                i += 1  # Skip next token
-            elif next_token.text == "une":
-                word = "ét'une"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["ét'une"] += 1
-                i += 1  # Skip next token
-            elif next_token.text[0] in 'aeiouhéà':
-                word = "é't"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["é't"] += 1
-            else:
-                word = token.text
-        elif token.text == "c'est":
-            if next_token.text == "un":
-                word = "cét'un"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["cét'un"] += 1
-                i += 1  # Skip next token
-            elif next_token.text == "une":
-                word = "cét'une"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["cét'une"] += 1
-                i += 1  # Skip next token
-            elif next_token.text[0] in 'aeiouhéà':
-                word = "cé't"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["cé't"] += 1
-            else:
-                word = token.text
-        elif token.text == "n'est":
-            if next_token.text == "un":
-                word = "n'ét'un"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["n'ét'un"] += 1
-                i += 1  # Skip next token
-            elif next_token.text == "une":
-                word = "n'ét'une"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["n'ét'une"] += 1
-                i += 1  # Skip next token
-            elif next_token.text[0] in 'aeiouhéà':
-                word = "né't"
-                liaisons.append((token.text, next_token.text, word))
-                replacements["né't"] += 1
-            else:
-                word = token.text
-        # Apply specific rule for "qu'" + "ils"/"elles"
-        elif token.text == "qu'" and next_token.text in {"ils", "elles"}:
-            word = "qu'#@%" + next_token.text[1:]
-            liaisons.append((token.text, next_token.text, word))
-            replacements["#@%"] += 1
-        # Apply general rules for liaisons with "s" for "ils" and "elles"
-        elif token.text in {"ils", "elles"} and next_token.text[0] in 'aeiouh':
-            word = token.text[:-1] + "#@%"
-            liaisons.append((token.text, next_token.text, word))
-            replacements[token.text + "#@%"] += 1
-        # Apply general rules for liaisons with "s"
-        elif token.text.endswith('s') and next_token.text[0] in 'aeiouhàé' and token.text.lower() not in exceptions_s and next_token.text.lower() not in exceptions_s:
-            word = token.text[:-1] + "#@%"
-            liaisons.append((token.text, next_token.text, "#@%"))
-            replacements["#@%"] += 1
-        # Apply general rules for other cases
-        else:
-            word = token.text
-        
-        modified_tokens.append(word + token.whitespace_)
-        i += 1
 
-    # Append the last token
-    modified_tokens.append(doc[-1].text + doc[-1].whitespace_)
+        word = rule['word'].format(stem=token.text[:-1], next_tail=next_token.text[1:])
+        liaisons.append((token.text, next_token.text, rule.get('logged', word)))
+        replacements[rule['counter'].format(token=token.text)] += 1
+
+        joins_next = rule.get('joins_next', False)
+        if journal.is_recording():
+            end_offset = next_token.idx + len(next_token.text) if joins_next else token.idx + len(token.text)
+            journal.add(token.idx, text[token.idx:end_offset], word)
+
+        pieces.append(text[position:token.idx])
+        pieces.append(word + token.whitespace_)
+        position = token.idx + len(token.text_with_ws)
+        next_index = i + 1
+        # The last token is always kept, even when joined into the word before it
+        if joins_next and i + 2 < len(doc):
+            position = doc[i + 2].idx
+            next_index = i + 2
+
+    pieces.append(text[position:end])
+    metrics.add_replacements({'liaisons': len(liaisons)})
 
-    return liaisons, ''.join(modified_tokens), replacements
+    return (liaisons, ''.join(pieces), replacements), max(position, end)
 
-# Process each file
-for filename in os.listdir(input_dir):
-    if filename.endswith(".txt"):
-        file_path = os.path.join(input_dir, filename)
+# Function to format the log of a liaison run
+def format_log(liaisons, replacements):
+    log_entries = [f"{liaison[0]} - {liaison[1]} replaced by {liaison[2]}" for liaison in liaisons]
+    log_entries.append("")
+    log_entries.append("Replacement counts:")
+    for key, value in replacements.items():
+        log_entries.append(f"{key}: {value}")
+    return log_entries
+
+# Function to run the stage on the text of a chapter
+def process_text(text):
+    liaisons, modified_text, replacements = identify_and_replace_liaisons(text)
+    return modified_text, format_log(liaisons, replacements)
+
+# Function to run the stage on a stream of chapters
+def process_texts(texts, batch_size=None, n_process=None):
+    for liaisons, modified_text, replacements in identify_and_replace_liaisons_in_texts(texts, batch_size, n_process):
+        yield modified_text, format_log(liaisons, replacements)
+
+if __name__ == "__main__":
+    # Ensure output and log directories exist
+    os.makedirs(log_dir, exist_ok=True)
+
+    filenames = [filename for filename in os.listdir(input_dir) if filename.endswith(".txt")]
+    file_paths = [os.path.join(input_dir, filename) for filename in filenames]
+
+    # Parse every file in one stream, then process each file
+    docs = shared_nlp.parse_many(shared_nlp.read_text_files(file_paths), components=spacy_components)
+    for filename, doc in zip(filenames, docs):
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                text = file.read()
-            
             # Identify and replace liaisons in the text
-            liaisons, modified_text, replacements = identify_and_replace_liaisons(text)
-            
+            liaisons, modified_text, replacements = replace_liaisons_in_doc(doc)
+            log_entries = format_log(liaisons, replacements)
+
             # Create a log for the file
             log_file_path = os.path.join(log_dir, f"{filename}_log.txt")
             with open(log_file_path, 'w', encoding='utf-8') as log_file:
                 log_file.write(f"File: {filename}\n\n")
-                for liaison in liaisons:
-                    log_file.write(f"{liaison[0]} - {liaison[1]} replaced by {liaison[2]}\n")
-                log_file.write("\nReplacement counts:\n")
-                for key, value in replacements.items():
-                    log_file.write(f"{key}: {value}\n")
+                for entry in log_entries:
+                    log_file.write(f"{entry}\n")
 
             # Write the modified text to output file
             output_file_path = os.path.join(output_dir, filename)
@@ -1,16 +1,27 @@
 import os
-import subprocess
 import time
 import logging
 import sys
+import argparse
 
 # Add the base directory to the PYTHONPATH
 base_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(os.path.dirname(base_dir))  # Go two levels up
 sys.path.append(base_dir)
 
-# Define the path for the txt_processed directory two levels up
-txt_processed_directory = os.path.join(parent_dir, "txt_processed")
+import metrics
+import shared_nlp
+
+# Files the metrics of every run are exported to in the txt_processed directory, by format
+metrics_file_names = {
+    "jsonl": "metrics.jsonl",
+    "prometheus": "metrics.prom",
+}
+
+# Name of the journal of the changes every stage makes to the chapters, in the txt_processed directory
+journal_file_name = "changes.jsonl"
+
+# Name of the build cache holding the output of every stage and chapter, in the txt_processed directory
+build_cache_name = ".build_cache"
 
 # List of subdirectories relative to the txt_processed directory
 subdirectories = [
@@ -27,21 +38,6 @@ subdirectories = [
     "9-names_correction",
 ]
 
-# List of Python scripts to run
-script_paths = [
-    # "pdf_2_txt.py",
-    "remove_pnum_hilight_title.py",
-    "split_chapters.py",
-    "clean_text.py",
-    "replace_numbers.py",
-    "fix_lines.py",
-    "liaisons.py",
-    "ent_ait_fix.py",
-    "replace_words.py",
-    "replace_special_chars.py",
-    "name_correction.py"
-]
-
 # Logging setup
 log_file_path = os.path.join(base_dir, 'processing.log')
 
@@ -76,37 +72,6 @@ def delete_txt_files_in_subdirectories(base_directory, subdirectories):
         else:
             logging.warning(f"Directory does not exist: {full_path}")
 
-# Function to update shebangs in scripts
-def update_shebang(script_path):
-    with open(script_path, 'r') as file:
-        lines = file.readlines()
-
-    if lines[0].startswith('#!'):
-        lines[0] = f'#!/usr/bin/env python3\n'
-    else:
-        lines.insert(0, f'#!/usr/bin/env python3\n')
-
-    with open(script_path, 'w') as file:
-        file.writelines(lines)
-
-def update_all_shebangs(script_paths):
-    for script_path in script_paths:
-        update_shebang(script_path)
-
-# Function to run a script and log its output
-def run_script(script_path):
-    start_time = time.time()
-    logging.debug(f"Running script: {script_path}")
-    result = subprocess.run(['python3', script_path], capture_output=True, text=True)
-    end_time = time.time()
-    output = result.stdout.strip()
-    errors = result.stderr.strip()
-
-    logging.info(f"Finished running script: {script_path} in {end_time - start_time:.2f} seconds")
-    logging.info(f"Output:\n{output}\n")
-    if errors:
-        logging.error(f"Errors:\n{errors}\n")
-
 def ensure_directories_exist(base_directory, subdirectories):
     for subdir in subdirectories:
         dir_path = os.path.join(base_directory, subdir)
@@ -114,29 +79,83 @@ def ensure_directories_exist(base_directory, subdirectories):
             os.makedirs(dir_path)
             logging.info(f"Created directory: {dir_path}")
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Atlas text cleaning pipeline")
+    parser.add_argument("--keep-intermediates", action="store_true",
+                        help="write the output of every stage to its txt_processed subdirectory for debugging")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="number of texts per nlp.pipe batch in the SpaCy stages")
+    parser.add_argument("--n-process", type=int, default=None,
+                        help="number of processes nlp.pipe uses in the SpaCy stages")
+    parser.add_argument("--chunk-size", type=int, default=shared_nlp.chunk_size,
+                        help="number of characters above which the SpaCy stages process a chapter in chunks "
+                             "of about this size")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes taking whole chapters through the stages")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="run the stages concurrently, every chapter going on to the next stage as soon as it "
+                             "is done with one")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="number of chapters waiting between two stages of a pipelined run, 2 by default")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="reprocess every chapter through every stage instead of reusing the build cache")
+    parser.add_argument("--metrics-format", choices=sorted(metrics_file_names), default="jsonl",
+                        help="format the metrics of the run are exported in")
+    parser.add_argument("--metrics-file", default=None,
+                        help="file to export the metrics of the run to, in txt_processed by default")
+    parser.add_argument("--journal-file", default=None,
+                        help="file the changes every stage makes to the chapters are recorded to, "
+                             "in txt_processed by default")
+    parser.add_argument("--chapter-logs", action="store_true",
+                        help="also write a log file per final chapter, besides the journal")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
     start_time = time.time()
-    script_paths_abs = [os.path.join(base_dir, script) for script in script_paths]
 
-    # Set up logging
-    setup_logging(log_file_path)
+    # The config and the stages, which read it, are only imported to run the
+    # pipeline, so the package can be imported without a config
+    import config
+    import pipeline
 
-    # Ensure directories exist
-    ensure_directories_exist(txt_processed_directory, subdirectories)
+    # The stages read the books from the base directory of the config and write
+    # to its txt_processed directory, as the stage scripts do
+    txt_processed_directory = os.path.join(config.base_dir, "txt_processed")
+    journal_file_path = args.journal_file or os.path.join(txt_processed_directory, journal_file_name)
+    queue_size = args.queue_size if args.queue_size is not None else pipeline.default_queue_size
 
-    # Delete .txt files in the specified subdirectories
-    delete_txt_files_in_subdirectories(txt_processed_directory, subdirectories)
-
-    # Update shebangs in all scripts
-    update_all_shebangs(script_paths_abs)
+    # Set up logging
+    setup_logging(log_file_path)
 
-    # Run scripts sequentially
-    for script_path in script_paths_abs:
-        run_script(script_path)
+    # Ensure directories exist, the stage subdirectories only when every stage output is kept
+    os.makedirs(txt_processed_directory, exist_ok=True)
+    if args.keep_intermediates:
+        ensure_directories_exist(txt_processed_directory, subdirectories)
+
+    # Delete .txt files left in the subdirectories by earlier runs
+    existing_subdirectories = [subdir for subdir in subdirectories
+                               if os.path.isdir(os.path.join(txt_processed_directory, subdir))]
+    delete_txt_files_in_subdirectories(txt_processed_directory, existing_subdirectories)
+
+    # Run every stage in process
+    shared_nlp.chunk_size = args.chunk_size
+    cache_directory = None if args.no_cache else os.path.join(txt_processed_directory, build_cache_name)
+    pipeline.run_pipeline(config.base_dir, txt_processed_directory, args.keep_intermediates,
+                          args.batch_size, args.n_process, cache_directory, args.workers,
+                          journal_file_path, args.chapter_logs, pipelined=args.pipelined,
+                          queue_size=queue_size)
+    logging.info(f"Changes recorded to {journal_file_path}")
 
     total_time = time.time() - start_time
     logging.info(f"Total time for all tasks: {total_time:.2f} seconds")
     print(f"Total time for all tasks: {total_time:.2f} seconds")
 
+    # Export the stage and chapter metrics of the run
+    metrics_file_path = args.metrics_file or os.path.join(txt_processed_directory,
+                                                          metrics_file_names[args.metrics_format])
+    metrics.export(metrics_file_path, args.metrics_format)
+    logging.info(f"Metrics saved to {metrics_file_path}")
+
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
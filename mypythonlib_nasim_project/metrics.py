@@ -0,0 +1,147 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Prefix of the metric names in the Prometheus export
+prometheus_prefix = "atlas_"
+
+# Help text of the metrics recorded by the pipeline
+metric_help = {
+    'stage_seconds': "Wall clock time spent in a stage",
+    'stage_input_chars': "Characters given to a stage",
+    'stage_output_chars': "Characters produced by a stage",
+    'stage_cache_hits': "Chapters whose stage output came from the build cache",
+    'stage_errors': "Chapters a stage failed on",
+    'replacements': "Replacements made by a stage, by kind",
+    'spacy_parse_seconds': "Time spent parsing with SpaCy",
+    'spacy_segments_parsed': "Segments sent to the SpaCy model",
+    'spacy_segments_reused': "Segments whose parse was reused from an earlier stage",
+    'run_seconds': "Wall clock time of the whole run",
+}
+
+# Values of the current run, keyed by metric name and sorted labels, updated
+# under a lock as the stages of a pipelined run record them from several threads
+_values = {}
+_lock = threading.Lock()
+
+# Labels added to every value recorded, like the stage and chapter being
+# processed, kept per thread
+_state = threading.local()
+
+def _labels():
+    return getattr(_state, 'labels', {})
+
+def _key(name, labels):
+    return name, tuple(sorted({**_labels(), **labels}.items()))
+
+# Function to add to a counter, labelled with the current stage and chapter
+def add(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+# Function to time a block of code into a counter of seconds
+@contextmanager
+def timer(name, **labels):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start_time, **labels)
+
+# Function to label every value recorded inside a block of code
+@contextmanager
+def labelled(**labels):
+    previous_labels = _labels()
+    _state.labels = {**previous_labels, **labels}
+    try:
+        yield
+    finally:
+        _state.labels = previous_labels
+
+# Function to count the replacements of a stage by kind, skipping the kinds never replaced
+def add_replacements(counts):
+    for kind, count in counts.items():
+        if count:
+            add('replacements', count, kind=kind)
+
+# Function to return the values recorded so far as records, and forget them.
+# Worker processes send these records back to be merged into the main process.
+def drain():
+    with _lock:
+        records = [{'metric': name, 'labels': dict(labels), 'value': value}
+                   for (name, labels), value in _values.items()]
+        _values.clear()
+    return records
+
+# Function to add records drained from another process
+def merge(records):
+    for record in records:
+        key = (record['metric'], tuple(sorted(record['labels'].items())))
+        with _lock:
+            _values[key] = _values.get(key, 0) + record['value']
+
+# Function to compute the per stage totals: time, throughput and the time left
+# to the Python rules once the SpaCy parse is taken out
+def stage_summaries():
+    totals = {}
+    for (name, labels), value in _values.items():
+        stage = dict(labels).get('stage')
+        if stage is not None and name in ('stage_seconds', 'stage_input_chars', 'spacy_parse_seconds'):
+            totals.setdefault(stage, {}).setdefault(name, 0)
+            totals[stage][name] += value
+
+    records = []
+    for stage, stage_totals in totals.items():
+        seconds = stage_totals.get('stage_seconds', 0)
+        parse_seconds = stage_totals.get('spacy_parse_seconds', 0)
+        if seconds:
+            records.append({'metric': 'stage_chars_per_second', 'labels': {'stage': stage},
+                            'value': stage_totals.get('stage_input_chars', 0) / seconds})
+        records.append({'metric': 'stage_rule_seconds', 'labels': {'stage': stage},
+                        'value': max(seconds - parse_seconds, 0)})
+    return records
+
+# Function to list every value of the run, followed by the stage summaries
+def collect():
+    records = [{'metric': name, 'labels': dict(labels), 'value': value}
+               for (name, labels), value in sorted(_values.items())]
+    return records + sorted(stage_summaries(), key=lambda record: record['metric'])
+
+# Function to format the metrics as JSON lines
+def format_json_lines(records):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Function to format the metrics in the Prometheus text format
+def format_prometheus(records):
+    lines = []
+    described = set()
+    for record in records:
+        name = prometheus_prefix + record['metric']
+        if name not in described:
+            described.add(name)
+            if record['metric'] in metric_help:
+                lines.append(f"# HELP {name} {metric_help[record['metric']]}")
+            metric_type = 'counter' if record['metric'] in metric_help else 'gauge'
+            lines.append(f"# TYPE {name} {metric_type}")
+        labels = ",".join(f'{label}="{_escape_label(value)}"' for label, value in sorted(record['labels'].items()))
+        lines.append(f"{name}{{{labels}}} {record['value']}" if labels else f"{name} {record['value']}")
+    return "\n".join(lines) + "\n"
+
+# Function to write the metrics of the run to a file, as JSON lines or in the Prometheus text format
+def export(file_path, metrics_format='jsonl'):
+    records = collect()
+    if metrics_format == 'prometheus':
+        content = format_prometheus(records)
+    else:
+        content = format_json_lines(records)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write(content)
+
+# Function to forget every value recorded
+def reset():
+    _values.clear()
@@ -1,65 +1,156 @@
 #!/usr/bin/env python3
 import os
-import spacy
+import re
 
+import journal
+import metrics
+import shared_nlp
+import word_index
+import word_trie
 from config import base_dir  # Import the base directory
 
-# Load SpaCy French large model
-nlp = spacy.load('fr_core_news_lg')
+# SpaCy components the stage reads: the person entities
+spacy_components = ['ner']
+
+# Suffix rules of the names, the first rule a name ends with applies
+name_replacements = {
+    'ez': 'ez', 'as': 'a', 'et': 'é', 'cer': 'cer', 'tier': 'tié', 'ault': 'o', 'ner': 'nèr',
+    'ber': 'bèr', 'ars': 'ar', 'ère': 'èr', 'zier': 'zié', 'champ': 'chan', 'igny': 'ini',
+    'nie': 'ni', 'ort': 'or', 'ard': 'ar', 'ières': 'ièr', 'aux': 'o', 'us': 'us',
+    'ois': 'oi', 'is': 'i', 'ent': 'en', 'ert': 'èr', 'os': 'o', 'ot': 'o',
+    'ah': 'a', 'ée': 'é', 'ès': 'è’sse', 'és': 'é', 'oix': 'oi', 'ets': 'et', 'ues': 'ue'
+}
+
+# Names left as they are
+exception_names = [
+    "Boris", "Paris", "Doris", "Elvis", "Curtis", "Travis", "Chris", "Dennis", "Francis", "Lewis","Mars","Julieet","Sébas","Sergent"
+    "Otis", "Phyllis", "Harris", "Morris", "Ennis", "Amaris", "Claris", "Wallis", "Jamis", "Yanis",
+    "Loris", "Ellis", "Anis", "Idris", "Euris", "Mavis", "Norris", "Tavis", "Maris", "Candis", "Jadis",
+    "Farris", "Ferris", "Avis", "Alis", "Eddis", "Iris", "Janis", "Jarvis", "Karis", "Ladis",
+    "Genesis", "Nelis", "Bris", "Chrys", "Daris", "Elis", "Eris", "Hollis", "Kelis", "Thais",
+    "Vallis", "Aulis", "Aris", "Clematis", "Clovis", "Damaris", "Ignis", "Rufus", "Silas",
+    "Achilles", "Cris", "Iris", "Myrtis", "Narcis", "Peris", "Tallis", "Yanis", "Siris", "Annis",
+    "Chris", "Davis", "Bigfoot", "Bigfoots", "Ward",
+    "Chavez", "Perez", "Gomez", "Martinez", "Vazquez", "Cortez", "Hernandez", "Juarez", "Lopez", "Mez",
+    "Lucas", "Jonas", "Thomas", "Nicholas", "Elias", "Tobias", "Zacharias", "Silas", "Pascal", "Mathias"
+]
+exception_name_set = frozenset(exception_names)
+suffix_rules = list(name_replacements.items())
+
+# Tables of rules the build cache covers chapter by chapter rather than
+# through the source, so editing them only runs the stage again on the
+# chapters they apply to
+indexed_tables = ('name_replacements', 'exception_names')
+
+# Function to list the exception names and the suffix rules as rules of the
+# build cache: an exception name applies to the chapters holding its word
+# forms, and a suffix rule to the chapters holding a word ending with it
+def indexed_rules():
+    return word_index.prepare_rules(
+        [(word_index.word_forms(name), None, ['exception', name]) for name in exception_names]
+        + [((), suffix, ['suffix', suffix, replacement]) for suffix, replacement in suffix_rules])
 
 def extract_and_replace_names(text):
-    doc = nlp(text)
-    name_replacements = {
-        'ez': 'ez', 'as': 'a', 'et': 'é', 'cer': 'cer', 'tier': 'tié', 'ault': 'o', 'ner': 'nèr',
-        'ber': 'bèr', 'ars': 'ar', 'ère': 'èr', 'zier': 'zié', 'champ': 'chan', 'igny': 'ini',
-        'nie': 'ni', 'ort': 'or', 'ard': 'ar', 'ières': 'ièr', 'aux': 'o', 'us': 'us',
-        'ois': 'oi', 'is': 'i', 'ent': 'en', 'ert': 'èr', 'os': 'o', 'ot': 'o',
-        'ah': 'a', 'ée': 'é', 'ès': 'è’sse', 'és': 'é', 'oix': 'oi', 'ets': 'et', 'ues': 'ue'
-    }
-
-    exception_names = [
-        "Boris", "Paris", "Doris", "Elvis", "Curtis", "Travis", "Chris", "Dennis", "Francis", "Lewis","Mars","Julieet","Sébas","Sergent"
-        "Otis", "Phyllis", "Harris", "Morris", "Ennis", "Amaris", "Claris", "Wallis", "Jamis", "Yanis",
-        "Loris", "Ellis", "Anis", "Idris", "Euris", "Mavis", "Norris", "Tavis", "Maris", "Candis", "Jadis",
-        "Farris", "Ferris", "Avis", "Alis", "Eddis", "Iris", "Janis", "Jarvis", "Karis", "Ladis",
-        "Genesis", "Nelis", "Bris", "Chrys", "Daris", "Elis", "Eris", "Hollis", "Kelis", "Thais",
-        "Vallis", "Aulis", "Aris", "Clematis", "Clovis", "Damaris", "Ignis", "Rufus", "Silas",
-        "Achilles", "Cris", "Iris", "Myrtis", "Narcis", "Peris", "Tallis", "Yanis", "Siris", "Annis",
-        "Chris", "Davis", "Bigfoot", "Bigfoots", "Ward",
-        "Chavez", "Perez", "Gomez", "Martinez", "Vazquez", "Cortez", "Hernandez", "Juarez", "Lopez", "Mez",
-        "Lucas", "Jonas", "Thomas", "Nicholas", "Elias", "Tobias", "Zacharias", "Silas", "Pascal", "Mathias"
-    ]
-
-    names = [ent.text for ent in doc.ents if ent.label_ == 'PER']
-    unique_names = set(names)
-    replaced_names = []
+    return next(extract_and_replace_names_in_texts([text], n_process=1))
+
+# Function to extract and replace the names of a stream of chapters, batched
+# through nlp.pipe. The names of a long chapter are found chunk by chunk, then
+# replaced in the whole text.
+def extract_and_replace_names_in_texts(texts, batch_size=None, n_process=None):
+    for text, doc in shared_nlp.parse_stream(texts, batch_size, n_process, spacy_components):
+        if doc is not None:
+            yield replace_names_in_doc(doc)
+        else:
+            names = {}
+            for chunk_names in shared_nlp.map_chunks(text, find_names_in_span, spacy_components):
+                names.update(chunk_names)
+            yield replace_names(text, names)
+
+# Function to build a trie of the reversed suffixes, keeping at the end of
+# every suffix its position in the suffix rules
+def build_suffix_trie(rules):
+    trie = {}
+    for index, (suffix, _) in enumerate(rules):
+        node = trie
+        for char in reversed(suffix):
+            node = node.setdefault(char, {})
+        node.setdefault('', index)
+    return trie
+
+suffix_trie = build_suffix_trie(suffix_rules)
+
+# Function to find the suffix rule of a name, walking the name backwards through
+# the trie and keeping the first rule of the list among the suffixes found
+def find_suffix_rule(name):
+    node = suffix_trie
+    found_index = None
+    for char in reversed(name):
+        node = node.get(char)
+        if node is None:
+            break
+        index = node.get('')
+        if index is not None and (found_index is None or index < found_index):
+            found_index = index
+    return None if found_index is None else suffix_rules[found_index]
+
+# Function to find the person names of the part of a parsed text between two
+# characters, in the order they first appear, with the end of the part
+def find_names_in_span(doc, start, end):
+    return dict.fromkeys(ent.text for ent in doc.ents if ent.label_ == 'PER' and start <= ent.start_char < end), end
+
+# Function to replace the names found in a parsed text
+def replace_names_in_doc(doc):
+    return replace_names(doc.text, find_names_in_span(doc, 0, len(doc.text))[0])
+
+# Function to replace every occurrence of the names in a text, besides the exception names
+def replace_names(text, names):
     log = {}
 
-    for name in unique_names:
-        if name in exception_names:
+    for name in names:
+        if name in exception_name_set:
             continue  # Skip the replacement for exception names
-        for suffix, replacement in name_replacements.items():
-            if name.endswith(suffix):
-                new_name = name[:-len(suffix)] + replacement
-                text = text.replace(name, new_name)
-                replaced_names.append(new_name)
-                log[name] = new_name
-                break
+        rule = find_suffix_rule(name)
+        if rule is not None:
+            suffix, replacement = rule
+            log[name] = name[:-len(suffix)] + replacement
 
-    return text, log
+    # Replace every occurrence of the names in a single pass, the longest name first where they overlap
+    if log:
+        name_pattern = re.compile(word_trie.trie_pattern(word_trie.build_trie(log)))
 
-def process_text_file(input_file_path, output_file_path, log_file_path):
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        text = file.read()
+        def replace_name(match):
+            journal.add(match.start(), match.group(), log[match.group()])
+            return log[match.group()]
 
+        text = name_pattern.sub(replace_name, text)
+
+    metrics.add_replacements({'names': len(log)})
+    return text, log
+
+# Function to run the stage on the text of a chapter
+def process_text(text):
     cleaned_text, replacements_log = extract_and_replace_names(text)
+    return cleaned_text, [f"{original}: {replacement}" for original, replacement in replacements_log.items()]
+
+# Function to run the stage on a stream of chapters
+def process_texts(texts, batch_size=None, n_process=None):
+    for cleaned_text, replacements_log in extract_and_replace_names_in_texts(texts, batch_size, n_process):
+        yield cleaned_text, [f"{original}: {replacement}" for original, replacement in replacements_log.items()]
 
+def write_outputs(output_file_path, log_file_path, cleaned_text, log_entries):
     with open(output_file_path, 'w', encoding='utf-8') as file:
         file.write(cleaned_text)
 
     with open(log_file_path, 'w', encoding='utf-8') as log_file:
-        for original, replacement in replacements_log.items():
-            log_file.write(f"{original}: {replacement}\n")
+        for entry in log_entries:
+            log_file.write(f"{entry}\n")
+
+def process_text_file(input_file_path, output_file_path, log_file_path):
+    with open(input_file_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+
+    cleaned_text, log_entries = process_text(text)
+    write_outputs(output_file_path, log_file_path, cleaned_text, log_entries)
 
 if __name__ == "__main__":
     input_directory = os.path.join(base_dir, "txt_processed/8-s_back_")
@@ -69,16 +160,19 @@ if __name__ == "__main__":
     os.makedirs(output_directory, exist_ok=True)
     os.makedirs(log_directory, exist_ok=True)
 
-    for file_name in os.listdir(input_directory):
-        if file_name.endswith('.txt'):
-            input_file_path = os.path.join(input_directory, file_name)
-            output_file_path = os.path.join(output_directory, file_name)
-            log_file_name = f"log_{file_name}"
-            log_file_path = os.path.join(log_directory, log_file_name)
-
-            print(f"Processing {file_name}...")
-            process_text_file(input_file_path, output_file_path, log_file_path)
-            print(f"Processed file saved as {file_name}")
-            print(f"Log saved as {log_file_name}")
+    file_names = [file_name for file_name in os.listdir(input_directory) if file_name.endswith('.txt')]
+    input_file_paths = [os.path.join(input_directory, file_name) for file_name in file_names]
+
+    # Parse every file in one stream
+    results = process_texts(shared_nlp.read_text_files(input_file_paths))
+    for file_name, (cleaned_text, log_entries) in zip(file_names, results):
+        output_file_path = os.path.join(output_directory, file_name)
+        log_file_name = f"log_{file_name}"
+        log_file_path = os.path.join(log_directory, log_file_name)
+
+        print(f"Processing {file_name}...")
+        write_outputs(output_file_path, log_file_path, cleaned_text, log_entries)
+        print(f"Processed file saved as {file_name}")
+        print(f"Log saved as {log_file_name}")
 
     print("Script completed")
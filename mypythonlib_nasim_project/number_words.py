@@ -0,0 +1,39 @@
+from num2words import num2words
+
+# Language of the words the numbers are written out in
+language = 'fr'
+
+_small_number_words = None
+
+# Function to build the table of the words of every number below a thousand, once per process
+def get_small_number_words():
+    global _small_number_words
+    if _small_number_words is None:
+        _small_number_words = [num2words(number, lang=language) for number in range(1000)]
+    return _small_number_words
+
+# Function to write out a number between 0 and 999999, giving the same words as
+# num2words(number, lang='fr') from the table of the numbers below a thousand
+def number_to_words(number):
+    small_number_words = get_small_number_words()
+    if number < 1000:
+        return small_number_words[number]
+
+    thousands, rest = divmod(number, 1000)
+    if thousands == 1:
+        words = "mille"
+    else:
+        thousands_words = small_number_words[thousands]
+
+        # "quatre-vingts" and "cents" lose their "s" before "mille"
+        if (thousands % 100 == 80 or thousands % 100 == 0) and thousands_words.endswith('s'):
+            thousands_words = thousands_words[:-1]
+        words = f"{thousands_words} mille"
+
+    if rest:
+        words = f"{words} {small_number_words[rest]}"
+    return words
+
+# Function to write out a batch of numbers given as digits, each distinct number written out once
+def numbers_to_words(numbers):
+    return {number: number_to_words(int(number)) for number in set(numbers)}
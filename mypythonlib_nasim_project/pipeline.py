@@ -0,0 +1,439 @@
+import os
+import time
+import queue
+import logging
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
+import build_cache
+import journal
+import metrics
+import remove_pnum_hilight_title
+import split_chapters
+import clean_text
+import replace_numbers
+import fix_lines
+import liaisons
+import ent_ait_fix
+import replace_words
+import replace_special_chars
+import name_correction
+import shared_nlp
+import word_index
+
+# Subdirectories of the book level stages
+page_number_directory = "1-page_nb_cln"
+chapter_split_directory = "2-chapter_split"
+book_info_directory = "10-book_info"
+
+# Chapter level stages in the order they run, with the subdirectory each one
+# writes to when intermediate outputs are kept
+chapter_stages = [
+    ("3-paragraph_fix", clean_text),
+    ("4-numbers_replaced", replace_numbers),
+    ("5-line-fix", fix_lines),
+    ("6-#@%_added_for_liasons", liaisons),
+    ("6-5-es_ait_", ent_ait_fix),
+    ("7-word_replacement_", replace_words),
+    ("8-s_back_", replace_special_chars),
+    ("9-names_correction", name_correction),
+]
+
+# Chapter level stages by subdirectory
+stage_modules = dict(chapter_stages)
+
+# Subdirectory holding the final chapters
+final_directory = chapter_stages[-1][0]
+
+# Function to name the final file of a chapter
+def final_file_name(chapter_name):
+    return chapter_name.replace('.txt', '_processed.txt')
+
+# Number of chapters waiting between two stages of a pipelined run before the
+# earlier stage has to wait for the later one
+default_queue_size = 2
+
+# The SpaCy stages share the model and the cache of parsed segments, so in a
+# pipelined run only one of them parses at a time
+_nlp_lock = threading.Lock()
+
+def write_text(directory, file_name, text):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, file_name), 'w', encoding='utf-8') as file:
+        file.write(text)
+
+# Function to build the lines of the log of a chapter stage. A stage can keep
+# compact log entries, like counted occurrences, and give a format_log_entries
+# function turning them into lines only when a log is written.
+def stage_log_lines(subdirectory, log_entries):
+    format_log_entries = getattr(stage_modules.get(subdirectory), 'format_log_entries', None)
+    return format_log_entries(log_entries) if format_log_entries is not None else log_entries
+
+def write_log(directory, file_name, log_entries):
+    log_directory = os.path.join(directory, 'logs')
+    log_file_name = f"log_{os.path.splitext(file_name)[0]}.txt"
+    write_text(log_directory, log_file_name, "\n".join(log_entries))
+
+# Function to record the size of the input and output of a stage for a chapter
+def count_chapter(text, result):
+    metrics.add('stage_input_chars', len(text))
+    metrics.add('stage_output_chars', len(result[0]))
+
+# Function to look the outputs of a stage up in the build cache. Returns the
+# cached results and the chapters still to process. The key of a stage with
+# indexed rules covers the rules applying to the chapter, found from the word
+# forms of its input in the word index of the book.
+def load_cached_results(module, chapters, cache_directory, fingerprint=None):
+    if cache_directory is None:
+        return {}, dict(chapters), {}
+
+    if fingerprint is None:
+        fingerprint = build_cache.stage_fingerprint(module)
+    indexed_rules = None
+    if hasattr(module, 'indexed_rules'):
+        try:
+            indexed_rules = module.indexed_rules()
+        except OSError as e:
+            # The data of the rules cannot be read, like a missing dictionary, so
+            # the stage runs uncached and fails chapter by chapter as without a cache
+            logging.warning(f"Not using the build cache for {module.__name__}: {e}")
+            return {}, dict(chapters), {}
+    index = word_index.get_index(cache_directory) if indexed_rules is not None else None
+    keys = {}
+    results = {}
+    pending = {}
+    for name, text in chapters.items():
+        rules = None
+        if index is not None:
+            forms = word_index.update_document(index, f"{module.__name__}/{name}", text)
+            rules = word_index.relevant_rules(forms, indexed_rules)
+        keys[name] = build_cache.cache_key(fingerprint, text, rules)
+        cached = build_cache.load_entry(cache_directory, keys[name])
+        if cached is None:
+            pending[name] = text
+        else:
+            results[name] = cached
+            metrics.add('stage_cache_hits', chapter=name)
+    return results, pending, keys
+
+# Function to store the new outputs of a stage in the build cache
+def store_results(results, keys, cache_directory):
+    if cache_directory is None:
+        return
+    for name, (text, log_entries, changes) in results.items():
+        if name not in keys:
+            continue
+        build_cache.store_entry(cache_directory, keys[name], text, log_entries, changes)
+
+# Function to run the book level stages and split every book into chapters
+def prepare_chapters(input_directory, output_directory, keep_intermediates=False, cache_directory=None):
+    chapters = {}
+
+    for file_name in sorted(os.listdir(input_directory)):
+        if not file_name.endswith('.txt'):
+            continue
+
+        with open(os.path.join(input_directory, file_name), 'r', encoding='utf-8') as file:
+            text = file.read()
+
+        with metrics.labelled(stage=page_number_directory, chapter=file_name):
+            results, pending, keys = load_cached_results(remove_pnum_hilight_title, {file_name: text}, cache_directory)
+            if pending:
+                with metrics.timer('stage_seconds'), journal.recording() as changes:
+                    results[file_name] = (*remove_pnum_hilight_title.process_text(
+                        text, remove_pnum_hilight_title.phrases_to_remove, remove_pnum_hilight_title.titles_to_mark),
+                        changes)
+                count_chapter(text, results[file_name])
+                store_results(results, keys, cache_directory)
+        text, log_entries, changes = results[file_name]
+        journal.write(page_number_directory, file_name, changes)
+
+        # The log of the titles, page numbers and phrases of the book is always kept
+        stage_directory = os.path.join(output_directory, page_number_directory)
+        write_log(stage_directory, file_name, log_entries)
+        if keep_intermediates:
+            write_text(stage_directory, file_name, text)
+
+        with metrics.labelled(stage=chapter_split_directory, chapter=file_name):
+            with metrics.timer('stage_seconds'):
+                book_info, book_chapters = split_chapters.split_book(text)
+            metrics.add('stage_input_chars', len(text))
+        if book_info is not None:
+            write_text(os.path.join(output_directory, book_info_directory),
+                       file_name.replace('.txt', '_info.txt'), book_info)
+
+        for chapter_name, content in book_chapters:
+            if keep_intermediates:
+                write_text(os.path.join(output_directory, chapter_split_directory), chapter_name, content)
+            chapters[chapter_name] = content
+
+        logging.info(f"Split {file_name} into {len(book_chapters)} chapters")
+
+    return chapters
+
+# Function to run a stage over every chapter, one chapter at a time. The result
+# of every chapter is its text, log entries and journal changes.
+def process_chapters(subdirectory, module, chapters):
+    results = {}
+    for chapter_name, text in chapters.items():
+        with metrics.labelled(stage=subdirectory, chapter=chapter_name):
+            try:
+                with metrics.timer('stage_seconds'), journal.recording() as changes:
+                    results[chapter_name] = (*module.process_text(text), changes)
+                count_chapter(text, results[chapter_name])
+            except Exception as e:
+                metrics.add('stage_errors')
+                logging.error(f"Error processing {chapter_name} in {subdirectory}: {e}")
+    return results
+
+# Function to run a stage over every chapter as one stream, for the stages that batch their SpaCy parse
+def process_chapter_stream(subdirectory, module, chapters, batch_size=None, n_process=None):
+    try:
+        outputs = module.process_texts(list(chapters.values()), batch_size, n_process)
+        results = {}
+        for chapter_name, text in chapters.items():
+            # The time of a chapter is the time taken to hand its output out of the stream
+            with metrics.labelled(stage=subdirectory, chapter=chapter_name):
+                with metrics.timer('stage_seconds'), journal.recording() as changes:
+                    results[chapter_name] = (*next(outputs), changes)
+                count_chapter(text, results[chapter_name])
+        return results
+    except Exception as e:
+        logging.error(f"Error processing the chapter stream in {subdirectory}, retrying one chapter at a time: {e}")
+        return process_chapters(subdirectory, module, chapters)
+
+# Function to run one chapter stage over every chapter
+def run_stage(subdirectory, module, chapters, chapter_logs, output_directory, keep_intermediates=False,
+              batch_size=None, n_process=None, cache_directory=None):
+    start_time = time.time()
+
+    # Reuse the outputs of the chapters whose input did not change
+    with metrics.labelled(stage=subdirectory):
+        results, pending, keys = load_cached_results(module, chapters, cache_directory)
+    if results:
+        logging.info(f"Reusing cached output of {len(results)} chapters in {subdirectory}")
+
+    if not pending:
+        new_results = {}
+    elif hasattr(module, 'process_texts'):
+        new_results = process_chapter_stream(subdirectory, module, pending, batch_size, n_process)
+    else:
+        new_results = process_chapters(subdirectory, module, pending)
+    store_results(new_results, keys, cache_directory)
+    results.update(new_results)
+
+    for chapter_name in list(chapters):
+        if chapter_name in results:
+            text, log_entries, changes = results[chapter_name]
+            record_stage_output(subdirectory, chapter_name, text, log_entries, changes, chapters, chapter_logs,
+                                output_directory, keep_intermediates)
+
+    logging.info(f"Finished stage {subdirectory} in {time.time() - start_time:.2f} seconds")
+
+# Function to keep the output of a stage for a chapter, adding its changes to the journal
+def record_stage_output(subdirectory, chapter_name, text, log_entries, changes, chapters, chapter_logs,
+                        output_directory, keep_intermediates=False):
+    chapters[chapter_name] = text
+    chapter_logs.setdefault(chapter_name, []).append((subdirectory, log_entries))
+    journal.write(subdirectory, chapter_name, changes)
+
+    if keep_intermediates:
+        stage_directory = os.path.join(output_directory, subdirectory)
+        # The text of the last stage is written as the final chapter
+        if subdirectory != final_directory:
+            write_text(stage_directory, chapter_name, text)
+        write_log(stage_directory, chapter_name, stage_log_lines(subdirectory, log_entries))
+
+# Function to load the SpaCy model once in every worker process
+def init_worker():
+    shared_nlp.get_nlp()
+
+# Function to take one chapter through every chapter stage, in a worker process.
+# Returns the (subdirectory, text, log entries, changes) of every stage that succeeded,
+# with the metrics recorded on the way.
+def process_chapter(chapter_name, text, cache_directory=None, fingerprints=None):
+    stage_outputs = []
+    for subdirectory, module in chapter_stages:
+        fingerprint = fingerprints.get(subdirectory) if fingerprints else None
+        with metrics.labelled(stage=subdirectory):
+            results, pending, keys = load_cached_results(module, {chapter_name: text}, cache_directory, fingerprint)
+        if pending:
+            results = process_chapters(subdirectory, module, pending)
+            store_results(results, keys, cache_directory)
+        if chapter_name in results:
+            text, log_entries, changes = results[chapter_name]
+            stage_outputs.append((subdirectory, text, log_entries, changes))
+    return stage_outputs, metrics.drain()
+
+# Function to run the chapter stages on a pool of worker processes, one chapter per task
+def run_chapter_stages_in_pool(chapters, chapter_logs, output_directory, keep_intermediates=False,
+                               cache_directory=None, workers=2):
+    start_time = time.time()
+    fingerprints = None
+    if cache_directory is not None:
+        fingerprints = {subdirectory: build_cache.stage_fingerprint(module) for subdirectory, module in chapter_stages}
+
+    chapter_names = list(chapters)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        outputs = executor.map(process_chapter, chapter_names, [chapters[name] for name in chapter_names],
+                               [cache_directory] * len(chapter_names), [fingerprints] * len(chapter_names))
+        for chapter_name, (stage_outputs, metric_records) in zip(chapter_names, outputs):
+            metrics.merge(metric_records)
+            for subdirectory, text, log_entries, changes in stage_outputs:
+                record_stage_output(subdirectory, chapter_name, text, log_entries, changes, chapters, chapter_logs,
+                                    output_directory, keep_intermediates)
+
+    logging.info(f"Finished the chapter stages on {workers} workers in {time.time() - start_time:.2f} seconds")
+
+# Function run by the thread of a stage in a pipelined run: takes the chapters
+# from its input queue as they come, runs the stage on each and puts it in its
+# output queue along with the (subdirectory, text, log entries, changes) of
+# every stage so far. A chapter the stage fails on goes on with its text
+# unchanged. After an error the thread keeps draining its input, so the
+# stages around it never wait forever, and None is passed on at the end.
+def run_pipelined_stage(subdirectory, module, input_queue, output_queue, errors, cache_directory=None,
+                        fingerprint=None):
+    nlp_lock = _nlp_lock if hasattr(module, 'process_texts') else nullcontext()
+    while True:
+        item = input_queue.get()
+        if item is None:
+            break
+        if errors:
+            continue
+        chapter_name, text, stage_outputs = item
+        try:
+            with metrics.labelled(stage=subdirectory):
+                results, pending, keys = load_cached_results(module, {chapter_name: text}, cache_directory,
+                                                             fingerprint)
+            if pending:
+                with nlp_lock:
+                    results = process_chapters(subdirectory, module, pending)
+                store_results(results, keys, cache_directory)
+            if chapter_name in results:
+                text, log_entries, changes = results[chapter_name]
+                stage_outputs.append((subdirectory, text, log_entries, changes))
+            output_queue.put((chapter_name, text, stage_outputs))
+        except Exception as e:
+            logging.exception(f"Error in the pipelined stage {subdirectory}")
+            errors.append(e)
+    output_queue.put(None)
+
+# Function to run the chapter stages as a pipeline, one thread per stage with
+# a bounded queue between every two stages, so a chapter goes on to the next
+# stage as soon as it is done with one. A full queue holds back the stage
+# feeding it, which keeps at most queue_size chapters waiting between two
+# stages. Every chapter is written to the final directory as soon as it leaves
+# the last stage. Returns the names of the chapters in the order they finished.
+def run_chapter_stages_pipelined(chapters, chapter_logs, output_directory, keep_intermediates=False,
+                                 cache_directory=None, queue_size=default_queue_size, write_logs=True):
+    start_time = time.time()
+    fingerprints = {}
+    if cache_directory is not None:
+        fingerprints = {subdirectory: build_cache.stage_fingerprint(module) for subdirectory, module in chapter_stages}
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(chapter_stages) + 1)]
+    errors = []
+    threads = [threading.Thread(target=run_pipelined_stage, name=f"stage-{subdirectory}",
+                                args=(subdirectory, module, queues[index], queues[index + 1], errors,
+                                      cache_directory, fingerprints.get(subdirectory)), daemon=True)
+               for index, (subdirectory, module) in enumerate(chapter_stages)]
+
+    # The chapters are updated as they finish, so the input is taken from a copy
+    chapter_items = list(chapters.items())
+
+    def feed_chapters():
+        for chapter_name, text in chapter_items:
+            queues[0].put((chapter_name, text, []))
+        queues[0].put(None)
+
+    threads.append(threading.Thread(target=feed_chapters, name="stage-input", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    finished = []
+    while True:
+        item = queues[-1].get()
+        if item is None:
+            break
+        chapter_name, text, stage_outputs = item
+        for subdirectory, text, log_entries, changes in stage_outputs:
+            record_stage_output(subdirectory, chapter_name, text, log_entries, changes, chapters, chapter_logs,
+                                output_directory, keep_intermediates)
+        write_final_chapters({chapter_name: chapters[chapter_name]}, chapter_logs, output_directory, write_logs)
+        if not finished:
+            logging.info(f"First chapter {chapter_name} finished after {time.time() - start_time:.2f} seconds")
+        finished.append(chapter_name)
+
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    logging.info(f"Finished the pipelined chapter stages in {time.time() - start_time:.2f} seconds")
+    return finished
+
+# Function to write the final chapters, with one log per chapter covering every stage
+def write_final_chapters(chapters, chapter_logs, output_directory, write_logs=True):
+    final_output_directory = os.path.join(output_directory, final_directory)
+
+    for chapter_name, text in chapters.items():
+        file_name = final_file_name(chapter_name)
+        write_text(final_output_directory, file_name, text)
+        if not write_logs:
+            continue
+
+        log_entries = []
+        for subdirectory, stage_log_entries in chapter_logs.get(chapter_name, []):
+            log_entries.append(f"== {subdirectory} ==")
+            log_entries.extend(stage_log_lines(subdirectory, stage_log_entries))
+            log_entries.append("")
+        write_log(final_output_directory, file_name, log_entries)
+
+# Function to run every stage in process, passing the chapters from one stage to
+# the next in memory. The changes of every stage go to the journal file when
+# one is given, and the log files of the final chapters are only written when
+# asked for. stage_done is called with the subdirectory of every stage once it
+# has processed every chapter. A pipelined run takes the chapters through the
+# stages concurrently, with queue_size chapters at most between two stages.
+def run_pipeline(input_directory, output_directory, keep_intermediates=False, batch_size=None, n_process=None,
+                 cache_directory=None, workers=1, journal_file=None, write_chapter_logs=True, stage_done=None,
+                 pipelined=False, queue_size=default_queue_size):
+    if stage_done is None:
+        stage_done = lambda subdirectory: None
+    if journal_file is not None:
+        journal.start(journal_file)
+    try:
+        with metrics.timer('run_seconds'):
+            chapters = prepare_chapters(input_directory, output_directory, keep_intermediates, cache_directory)
+            if not chapters:
+                logging.warning(f"No chapters found in the input directory: {input_directory}")
+                return chapters
+            stage_done(page_number_directory)
+            stage_done(chapter_split_directory)
+
+            chapter_logs = {}
+            if workers > 1:
+                run_chapter_stages_in_pool(chapters, chapter_logs, output_directory, keep_intermediates,
+                                           cache_directory, workers)
+                for subdirectory, _ in chapter_stages:
+                    stage_done(subdirectory)
+            elif pipelined:
+                run_chapter_stages_pipelined(chapters, chapter_logs, output_directory, keep_intermediates,
+                                             cache_directory, queue_size, write_chapter_logs)
+                for subdirectory, _ in chapter_stages:
+                    stage_done(subdirectory)
+            else:
+                for subdirectory, module in chapter_stages:
+                    run_stage(subdirectory, module, chapters, chapter_logs, output_directory, keep_intermediates,
+                              batch_size, n_process, cache_directory)
+                    stage_done(subdirectory)
+
+            # A pipelined run wrote every final chapter as soon as it was done
+            if workers > 1 or not pipelined:
+                write_final_chapters(chapters, chapter_logs, output_directory, write_chapter_logs)
+        return chapters
+    finally:
+        if cache_directory is not None:
+            word_index.save(cache_directory)
+        journal.stop()
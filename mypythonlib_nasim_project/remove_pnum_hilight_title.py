@@ -1,44 +1,183 @@
 #!/usr/bin/env python3
 import os
 import re
+import bisect
 import unicodedata
 
+import journal
+import word_trie
 from config import base_dir  # Import the base directory
 
 
-# Function to highlight chapter titles
+# Phrases and chapter titles of the book being processed
+phrases_to_remove = ['Le danger d’y croire', 'Les Illuminés']
+titles_to_mark = [
+    "Chapitre 1 Sous les projecteurs",
+    "Chapitre 2 Au printemps comme en hiver",
+    "Chapitre 3 Quand ça tourne... au vinaigre",
+    "Chapitre 4 Le compas dans l'oeil",
+    "Chapitre 5 Les étoiles qui pâlissent",
+    "Chapitre 6 Là où on ne les attendait pas",
+    "Chapitre 7 L'apparition",
+    "Chapitre 8 L'oeil aveugle",
+    "Chapitre 9 Rencontres au zénith",
+    "Chapitre 10 Jour de repos",
+    "Chapitre 11 Erreur sur la ligne",
+    "Chapitre 12 Révélations",
+    "Chapitre 13 Les plans secrets",
+    "Chapitre 14 Retour à l'école",
+    "Chapitre 15 Retrouvailles au sommet",
+    "Chapitre 16 La convocation"
+]
+
+# Function to split a title into its chapter heading, like "Chapitre 3", and its title text
+def split_title(title):
+    parts = title.split(' ', 2)
+    chapter = ' '.join(parts[:2])
+    chapter_title = parts[2] if len(parts) > 2 else ''
+    return chapter, chapter_title
+
+# Function to check that a title can be located on the text as it was before
+# any marker was added. The markers only make a difference for titles holding
+# an '@' or a line break, starting or ending with a space, or without a heading.
+def can_locate(chapter, chapter_title):
+    return (chapter != '' and '@' not in chapter + chapter_title and '\n' not in chapter
+            and chapter == chapter.strip(' ') and chapter_title == chapter_title.strip(' '))
+
+# Function to index the lines of a text by the chapter headings they start with,
+# in one scan of the text. A line starting with "Chapitre 12" starts with the
+# heading "Chapitre 1" too.
+def index_headings(text, chapters):
+    heading_pattern = re.compile('^' + word_trie.trie_pattern(word_trie.build_trie(chapters)), re.MULTILINE)
+    headings = {chapter: [] for chapter in chapters}
+    prefixes = {}
+    for match in heading_pattern.finditer(text):
+        line_heading = match.group()
+        if line_heading not in prefixes:
+            prefixes[line_heading] = [chapter for chapter in chapters if line_heading.startswith(chapter)]
+        for chapter in prefixes[line_heading]:
+            headings[chapter].append(match.start())
+    return headings
+
+# Function to record the lines of a text its NFC normalization changes
+def journal_normalization(text, normalized_text):
+    offset = 0
+    for line, normalized_line in zip(text.split('\n'), normalized_text.split('\n')):
+        if line != normalized_line:
+            journal.add(offset, line, normalized_line)
+        offset += len(line) + 1
+
+# Function to highlight chapter titles, in the text normalized to NFC
 def highlight_titles(text, titles):
+    # Normalize text to ensure consistency in accent handling
+    normalized_text = unicodedata.normalize('NFC', text)
+    with journal.steps() as step:
+        if journal.is_recording() and normalized_text != text:
+            with step():
+                journal_normalization(text, normalized_text)
+        with step():
+            return mark_titles(normalized_text, titles)
+
+# Function to mark chapter titles. Every title is marked from the first line
+# starting with its chapter heading to the first occurrence of its title text
+# after it, like a regex ^chapter[\s\S]*?title would, but the headings are
+# indexed once and the markers are added in a single rebuild of the text.
+def mark_titles(normalized_text, titles):
     log_entries = []
     marked_titles = set()
 
-    # Normalize text to ensure consistency in accent handling
-    normalized_text = unicodedata.normalize('NFC', text)
+    normalized_titles = [unicodedata.normalize('NFC', title) for title in titles]
+    split_titles = [split_title(title) for title in normalized_titles]
+    if not all(can_locate(chapter, chapter_title) for chapter, chapter_title in split_titles):
+        return highlight_titles_with_regexes(normalized_text, normalized_titles)
+
+    headings = index_headings(normalized_text, {chapter for chapter, _ in split_titles})
+    next_headings = dict.fromkeys(headings, 0)
+
+    # Markers to add as (position, order, marker), and the sorted positions of the markers
+    markers = []
+    marker_positions = []
+
+    # Function to check for a marker in the middle of a part of the text, or at its start
+    def has_marker(start, end, at_start=False):
+        index = bisect.bisect_left(marker_positions, start) if at_start else bisect.bisect_right(marker_positions, start)
+        return index < len(marker_positions) and marker_positions[index] < end
 
-    for title in titles:
-        # Normalize the title
-        normalized_title = unicodedata.normalize('NFC', title)
+    for normalized_title, (chapter, chapter_title) in zip(normalized_titles, split_titles):
+        # Only mark the title if it hasn't been marked yet
+        if normalized_title in marked_titles:
+            continue
+
+        # First line starting with the heading that no marker has been added to
+        start = None
+        candidates = headings[chapter]
+        while next_headings[chapter] < len(candidates):
+            candidate = candidates[next_headings[chapter]]
+            if not has_marker(candidate, candidate + len(chapter), at_start=True):
+                start = candidate
+                break
+            next_headings[chapter] += 1
 
+        end = None
+        if start is not None:
+            position = normalized_text.find(chapter_title, start + len(chapter))
+            while position != -1 and has_marker(position, position + len(chapter_title)):
+                position = normalized_text.find(chapter_title, position + 1)
+            if position != -1:
+                end = position + len(chapter_title)
+
+        if end is not None:
+            # A later marker closing at the same place goes before the earlier ones
+            markers.append((start, 0, '@@ '))
+            markers.append((end, -len(markers), ' @@'))
+            bisect.insort(marker_positions, start)
+            bisect.insort(marker_positions, end)
+            log_entries.append(f"Added markers to title: {normalized_title}, Occurrences: 1")
+            marked_titles.add(normalized_title)
+        else:
+            log_entries.append(f"Title not found in text: {normalized_title}")
+
+    pieces = []
+    last_position = 0
+    for position, _, marker in sorted(markers):
+        pieces.append(normalized_text[last_position:position])
+        pieces.append(marker)
+        journal.add(position, '', marker)
+        last_position = position
+    pieces.append(normalized_text[last_position:])
+
+    return ''.join(pieces), log_entries
+
+# Function to highlight chapter titles with a regex per title, for the titles
+# that can not be located on the text before any marker is added
+def highlight_titles_with_regexes(normalized_text, normalized_titles):
+    log_entries = []
+    marked_titles = set()
+    changes = []
+
+    for normalized_title in normalized_titles:
         # Split the title into chapter and title parts
-        parts = normalized_title.split(' ', 2)
-        chapter = ' '.join(parts[:2])
-        chapter_title = parts[2] if len(parts) > 2 else ''
+        chapter, chapter_title = split_title(normalized_title)
 
         # Ensure the pattern matches the chapter title format with possible line breaks, varying whitespace, and optional punctuation
         title_pattern = re.compile(r'(^' + re.escape(chapter) + r'[\s\S]*?' + re.escape(chapter_title) + r')', re.MULTILINE)
-        alt_title_pattern = re.compile(r'(^' + re.escape(chapter) + r'[\s\S]+?' + re.escape(chapter_title) + r')', re.MULTILINE)
 
         # Only mark the title if it hasn't been marked yet
         if normalized_title not in marked_titles:
+            if journal.is_recording():
+                match = title_pattern.search(normalized_text)
+                if match:
+                    # Markers of the text as marked so far, as changes of the text given
+                    changes = journal.compose(changes, [(match.start(), '', '@@ '), (match.end(), '', ' @@')])
             new_title = r'@@ \1 @@'
             normalized_text, count = title_pattern.subn(new_title, normalized_text, count=1)  # Mark only once
-            if count == 0:
-                normalized_text, count = alt_title_pattern.subn(new_title, normalized_text, count=1)  # Mark only once
             if count > 0:
                 log_entries.append(f"Added markers to title: {normalized_title}, Occurrences: {count}")
                 marked_titles.add(normalized_title)
             else:
                 log_entries.append(f"Title not found in text: {normalized_title}")
 
+    journal.extend(changes)
     return normalized_text, log_entries
 
 # Function to remove standalone numbers, skipping lines with '@@'
@@ -52,6 +191,7 @@ def remove_numbers(text):
         else:
             number = int(match.group(2))
             log_entries.append(f"Removed number: {number}")
+            journal.add(match.start(2), match.group(2), '')
             return match.group(1) + match.group(3)
 
     number_pattern = re.compile(r'(\s+)(\d+)(\s*\n\s*\n)')
@@ -62,43 +202,75 @@ def remove_numbers(text):
 # Function to remove phrases at the start of paragraphs
 def remove_phrase_at_paragraph_start(text, phrases):
     log_entries = []
+    changes = []
 
     for phrase in phrases:
         phrase_pattern = re.compile(r'(?<=\n\n)' + re.escape(phrase) + r'(?=\s)', re.MULTILINE)
+        if journal.is_recording():
+            # Phrases of the text left by the phrases before, as changes of the text given
+            changes = journal.compose(changes, [(match.start(), phrase, '') for match in phrase_pattern.finditer(text)])
         text, count = phrase_pattern.subn('', text)
         if count > 0:
             log_entries.append(f"Removed phrase: {phrase}")
 
+    journal.extend(changes)
     return text, log_entries
 
-def process_text_file(input_file_path, output_file_path, log_file_path, phrases, titles):
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        text = file.read()
+# Function to run the whole stage on the text of a book. Every step works on
+# the text left by the steps before it, and the journal offsets of all of them
+# are in the text of the book.
+def process_text(text, phrases, titles):
+    with journal.steps() as step:
+        # Extract book info before the first @@ marker
+        if '@@' in text:
+            book_info = text.split('@@', 1)[0].strip()
+            if journal.is_recording() and not text.startswith('@@'):
+                with step():
+                    journal.add(0, text.split('@@', 1)[0], '')
+            text = text.split('@@', 1)[1]
+            text = '@@' + text  # Add the marker back to the beginning
+
+        # Highlight titles
+        with step():
+            highlighted_text, title_log_entries = highlight_titles(text, titles)
 
-    # Extract book info before the first @@ marker
-    if '@@' in text:
-        book_info = text.split('@@', 1)[0].strip()
-        text = text.split('@@', 1)[1]
-        text = '@@' + text  # Add the marker back to the beginning
+        # Remove phrases at the start of paragraphs (after the first @@ marker)
+        book_info, remaining_text = highlighted_text.split('@@', 1)
+        with step(), journal.shifted(len(book_info)):
+            cleaned_text, phrase_log_entries = remove_phrase_at_paragraph_start('@@' + remaining_text, phrases)
 
-    # Highlight titles
-    highlighted_text, title_log_entries = highlight_titles(text, titles)
+        # Remove standalone numbers
+        with step(), journal.shifted(len(book_info)):
+            cleaned_text, number_log_entries = remove_numbers(cleaned_text)
 
-    # Remove phrases at the start of paragraphs (after the first @@ marker)
-    book_info, remaining_text = highlighted_text.split('@@', 1)
-    cleaned_text, phrase_log_entries = remove_phrase_at_paragraph_start('@@' + remaining_text, phrases)
+        if journal.is_recording():
+            stripped_length = len(cleaned_text.rstrip())
+            if stripped_length < len(cleaned_text):
+                with step(), journal.shifted(len(book_info)):
+                    journal.add(stripped_length, cleaned_text[stripped_length:], '')
 
-    # Remove standalone numbers
-    cleaned_text, number_log_entries = remove_numbers(cleaned_text)
+            # The book info is kept stripped, followed by a blank line
+            kept_book_info = book_info.strip() + '\n\n' if book_info.strip() else ''
+            if kept_book_info != book_info:
+                with step():
+                    journal.add(0, book_info, kept_book_info)
 
     # Combine book info with cleaned text
     final_text = book_info.strip() + '\n\n' + cleaned_text
 
+    return final_text.strip(), title_log_entries + number_log_entries + phrase_log_entries
+
+def process_text_file(input_file_path, output_file_path, log_file_path, phrases, titles):
+    with open(input_file_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+
+    final_text, log_entries = process_text(text, phrases, titles)
+
     with open(output_file_path, 'w', encoding='utf-8') as file:
-        file.write(final_text.strip())
+        file.write(final_text)
 
     with open(log_file_path, 'w', encoding='utf-8') as log_file:
-        log_file.write("\n".join(title_log_entries + number_log_entries + phrase_log_entries))
+        log_file.write("\n".join(log_entries))
 
 def process_directory(input_directory, output_directory, log_directory, phrases, titles):
     print("Hello World")
@@ -122,25 +294,6 @@ if __name__ == "__main__":
     input_directory = os.path.join(base_dir)
     output_directory = os.path.join(base_dir, "txt_processed/1-page_nb_cln")
     log_directory = os.path.join(output_directory, "logs")
-    phrases_to_remove = ['Le danger d’y croire', 'Les Illuminés']
-    titles_to_mark = [
-        "Chapitre 1 Sous les projecteurs",
-        "Chapitre 2 Au printemps comme en hiver",
-        "Chapitre 3 Quand ça tourne... au vinaigre",
-        "Chapitre 4 Le compas dans l'oeil",
-        "Chapitre 5 Les étoiles qui pâlissent",
-        "Chapitre 6 Là où on ne les attendait pas",
-        "Chapitre 7 L'apparition",
-        "Chapitre 8 L'oeil aveugle",
-        "Chapitre 9 Rencontres au zénith",
-        "Chapitre 10 Jour de repos",
-        "Chapitre 11 Erreur sur la ligne",
-        "Chapitre 12 Révélations",
-        "Chapitre 13 Les plans secrets",
-        "Chapitre 14 Retour à l'école",
-        "Chapitre 15 Retrouvailles au sommet",
-        "Chapitre 16 La convocation"
-    ]
 
     process_directory(input_directory, output_directory, log_directory, phrases_to_remove, titles_to_mark)
     print("Script completed")
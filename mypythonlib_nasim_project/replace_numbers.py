@@ -1,34 +1,53 @@
 #!/usr/bin/env python3
 import os
 import re
-from num2words import num2words
 
+import journal
+import metrics
+import number_words
 from config import base_dir  # Import the base directory
 
-def replace_numbers_with_words(text):
-    log_entries = []
+# Numbers between 0 and 999999
+number_pattern = re.compile(r'\b([0-9]{1,6})\b')
 
-    def replace_number(match):
-        number = int(match.group())
-        words = num2words(number, lang='fr')
-        log_entries.append(f"{number}: {words}")
-        return words
+def replace_numbers_with_words(text):
+    # Split the text around the numbers, which end up at the odd positions
+    pieces = number_pattern.split(text)
+    numbers = pieces[1::2]
 
-    # Replace numbers between 0 and 999999
-    text = re.sub(r'\b([0-9]{1,6})\b', replace_number, text)
-    return text, log_entries
+    # Write out every distinct number of the text once
+    words = number_words.numbers_to_words(numbers)
+    pieces[1::2] = [words[number] for number in numbers]
 
-def process_text_file(input_file_path, output_file_path, log_file_path):
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        text = file.read()
+    log_entries = [f"{int(number)}: {words[number]}" for number in numbers]
+    if journal.is_recording():
+        for match in number_pattern.finditer(text):
+            journal.add(match.start(), match.group(), words[match.group()])
+    metrics.add_replacements({'numbers': len(log_entries)})
+    return ''.join(pieces), log_entries
 
-    cleaned_text, log_entries = replace_numbers_with_words(text)
+# Function to run the stage on the text of a chapter
+def process_text(text):
+    return replace_numbers_with_words(text)
 
-    with open(output_file_path, 'w', encoding='utf-8') as file:
-        file.write(cleaned_text)
+# Function to replace the numbers of a stream of lines, yielding every line
+# with its log entries as soon as it is processed. Numbers never span lines,
+# so this gives the same result as processing the whole text.
+def replace_numbers_in_lines(lines):
+    for line in lines:
+        yield replace_numbers_with_words(line)
 
-    with open(log_file_path, 'w', encoding='utf-8') as log_file:
-        log_file.write("\n".join(log_entries))
+# Function to replace the numbers of a file, reading and writing it one line at a time
+def process_text_file(input_file_path, output_file_path, log_file_path):
+    with open(input_file_path, 'r', encoding='utf-8') as input_file, \
+            open(output_file_path, 'w', encoding='utf-8') as output_file, \
+            open(log_file_path, 'w', encoding='utf-8') as log_file:
+        separator = ''
+        for line, log_entries in replace_numbers_in_lines(input_file):
+            output_file.write(line)
+            for entry in log_entries:
+                log_file.write(separator + entry)
+                separator = '\n'
 
 def process_directory(input_directory, output_directory, log_directory):
     if not os.path.exists(output_directory):
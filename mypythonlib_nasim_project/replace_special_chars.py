@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import os
 import re
+from collections import Counter
 
+import journal
+import metrics
 from config import base_dir  # Import the base directory
 
 # Directory paths
@@ -9,15 +12,9 @@ input_dir = os.path.join(base_dir, "txt_processed/7-word_replacement_")
 output_dir = os.path.join(base_dir, "txt_processed/8-s_back_")
 log_dir = os.path.join(output_dir, "logs")
 
-# Ensure the output directories exist
-os.makedirs(output_dir, exist_ok=True)
-os.makedirs(log_dir, exist_ok=True)
-
-# Function to process each file and replace occurrences
-def process_file(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-    
+# Function to replace the liaison markers of a text. The replaced occurrences
+# are given as (occurrence, replacement, count).
+def replace_special_chars(content):
     # Find and replace all occurrences of #@%
     replacements = {
         r'#@%': 's'
@@ -27,10 +24,36 @@ def process_file(file_path):
     
     for pattern, replacement in replacements.items():
         occurrences = re.findall(pattern, content)
+        if occurrences and journal.is_recording():
+            for match in re.finditer(pattern, content):
+                journal.add(match.start(), match.group(), replacement)
         if occurrences:
-            replaced_words.extend([(occurrence, replacement) for occurrence in occurrences])
+            replaced_words.extend((occurrence, replacement, count) for occurrence, count in Counter(occurrences).items())
             content = re.sub(pattern, replacement, content)
+
+    metrics.add_replacements({'special_chars': sum(count for _, _, count in replaced_words)})
+    return content, replaced_words
+
+# Function to build the lines of the log from the replaced occurrences, one
+# line per occurrence. The stage keeps the occurrences as its log entries, so
+# the lines are only built when a log is written.
+def format_log_entries(replaced_words):
+    return [f"Replaced: {old} with '{new}'" for old, new, count in replaced_words for _ in range(count)]
+
+# Function to run the stage on the text of a chapter
+def process_text(text):
+    return replace_special_chars(text)
+
+# Function to process each file and replace occurrences
+def process_file(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        content = file.read()
     
+    content, replaced_words = replace_special_chars(content)
+    
+    # Ensure the output directories exist
+    os.makedirs(log_dir, exist_ok=True)
+
     # Write the processed content to a new file
     output_file_path = os.path.join(output_dir, os.path.basename(file_path).replace(".txt", "_processed.txt"))
     with open(output_file_path, 'w', encoding='utf-8') as file:
@@ -41,14 +64,15 @@ def process_file(file_path):
         log_file_path = os.path.join(log_dir, os.path.basename(file_path).replace(".txt", "_log.txt"))
         with open(log_file_path, 'w', encoding='utf-8') as log_file:
             log_file.write(f"File: {os.path.basename(file_path)}\n")
-            for old, new in replaced_words:
-                log_file.write(f"Replaced: {old} with '{new}'\n")
+            for line in format_log_entries(replaced_words):
+                log_file.write(f"{line}\n")
             log_file.write("\n")
 
-# Process each .txt file in the directory
-for filename in os.listdir(input_dir):
-    if filename.endswith(".txt") and not filename.endswith("_processed.txt"):
-        file_path = os.path.join(input_dir, filename)
-        process_file(file_path)
+if __name__ == "__main__":
+    # Process each .txt file in the directory
+    for filename in os.listdir(input_dir):
+        if filename.endswith(".txt") and not filename.endswith("_processed.txt"):
+            file_path = os.path.join(input_dir, filename)
+            process_file(file_path)
 
-print("Processing complete.")
+    print("Processing complete.")
@@ -3,7 +3,13 @@ import json
 import re
 import os
 import glob
+import hashlib
+import logging
 
+import journal
+import metrics
+import word_index
+import word_trie
 from config import base_dir  # Import the base directory
 
 def flatten_nested_json(nested_json):
@@ -15,13 +21,232 @@ def flatten_nested_json(nested_json):
             flat_dict[key] = value
     return flat_dict
 
-def replace_words_using_json(json_file, input_dir, output_dir, log_dir):
-    # Load the content of the JSON file
-    with open(json_file, 'r', encoding='utf-8') as file:
-        nested_word_pairs = json.load(file)
+# Runs of word characters and of other characters. A match bounded by \b is
+# made of whole runs of the text it is found in.
+run_pattern = re.compile(r'\w+|\W+')
+
+# Function to split a dictionary word or replacement into its runs, in lower case
+def word_runs(word):
+    return tuple(run_pattern.findall(word.lower()))
+
+# Function to tell whether a run is made of word characters
+def is_word_run(run):
+    return re.match(r'\w', run) is not None
+
+# Function to check whether the matches of two dictionary words can overlap in
+# a text, one word holding the other or ending with the start of the other
+def can_overlap(runs, other_runs):
+    for first, second in ((runs, other_runs), (other_runs, runs)):
+        for start in range(len(first)):
+            length = min(len(first) - start, len(second))
+            if first[start:start + length] == second[:length]:
+                return True
+    return False
+
+# Function to check whether replacing a word can make or break a match of
+# another word, across or next to the replacement. When the replacement keeps
+# the kind of characters at both ends of the word, its runs are whole runs of
+# the text, so the other word has to share one of them.
+def can_chain(runs, replacement_runs, other_runs):
+    if replacement_runs and is_word_run(replacement_runs[0]) == is_word_run(runs[0]) \
+            and is_word_run(replacement_runs[-1]) == is_word_run(runs[-1]):
+        for run in other_runs:
+            if is_word_run(run):
+                if run in replacement_runs:
+                    return True
+            elif run in (replacement_runs[0], replacement_runs[-1]):
+                return True
+        return len(other_runs) == 1 and other_runs[0] in replacement_runs
+
+    # Otherwise the runs around the replacement change too: the other word can
+    # hold part of them, or start or end right next to the replacement
+    if any(run in other_run for run in replacement_runs for other_run in other_runs):
+        return True
+    if not replacement_runs and len(other_runs) > 1:
+        return True
+    if (not replacement_runs or is_word_run(replacement_runs[-1]) != is_word_run(runs[-1])) \
+            and is_word_run(other_runs[0]) != is_word_run(runs[-1]):
+        return True
+    return (not replacement_runs or is_word_run(replacement_runs[0]) != is_word_run(runs[0])) \
+        and is_word_run(other_runs[-1]) != is_word_run(runs[0])
+
+# Function to list the dictionary words whose matches can overlap the matches
+# of other words, or be made or broken by their replacements. Replacing them
+# in a single pass could give another text than replacing the words one after
+# another, so they are replaced in dictionary order after the other words.
+def find_sequential_words(word_pairs):
+    words = [word for word in word_pairs if word]
+    runs = [word_runs(word) for word in words]
+    words_by_run = {}
+    for position, word_run_list in enumerate(runs):
+        for run in set(word_run_list):
+            words_by_run.setdefault(run, []).append(position)
+
+    sequential = set()
+    for position, word in enumerate(words):
+        for other in words_by_run[runs[position][0]]:
+            if other != position and can_overlap(runs[position], runs[other]):
+                sequential.update((position, other))
+
+        replacement_runs = word_runs(word_pairs[word])
+        if replacement_runs and is_word_run(replacement_runs[0]) == is_word_run(runs[position][0]) \
+                and is_word_run(replacement_runs[-1]) == is_word_run(runs[position][-1]):
+            candidates = set()
+            for run in set(replacement_runs):
+                candidates.update(words_by_run.get(run, ()))
+        else:
+            candidates = range(len(words))
+        for other in candidates:
+            if other != position and can_chain(runs[position], replacement_runs, runs[other]):
+                sequential.update((position, other))
+    return [word for position, word in enumerate(words) if position in sequential]
+
+# Function to build the source of the matcher of the dictionary words replaced in a single pass
+def build_matcher_pattern(word_pairs, sequential_words=()):
+    sequential_words = set(sequential_words)
+    trie = word_trie.build_trie(word for word in word_pairs if word not in sequential_words)
+    if not trie:
+        return None
+    return r'\b' + (word_trie.trie_pattern(trie) or '') + r'\b'
+
+# Function to load a dictionary with its compiled matcher and the words
+# replaced one after another. Both are cached next to the JSON file and only
+# worked out again when the file changes.
+def load_matcher(json_file):
+    with open(json_file, 'rb') as file:
+        raw_dictionary = file.read()
+    dictionary_hash = hashlib.sha256(raw_dictionary).hexdigest()
+    word_pairs = flatten_nested_json(json.loads(raw_dictionary.decode('utf-8')))
+
+    cache_file = os.path.splitext(json_file)[0] + '.matcher.json'
+    cached = None
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as file:
+                cached = json.load(file)
+            if cached.get('dictionary_hash') != dictionary_hash or 'sequential_words' not in cached:
+                cached = None
+            else:
+                pattern, sequential_words = cached['pattern'], cached['sequential_words']
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            logging.warning(f"Ignoring unreadable matcher cache {cache_file}: {e}")
+            cached = None
+
+    if cached is None:
+        sequential_words = find_sequential_words(word_pairs)
+        pattern = build_matcher_pattern(word_pairs, sequential_words)
+        # The cache only saves building the pattern again, so the matcher
+        # built here is used even when the cache can not be written
+        temporary_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_file, 'w', encoding='utf-8') as file:
+                json.dump({'dictionary_hash': dictionary_hash, 'pattern': pattern,
+                           'sequential_words': sequential_words}, file, ensure_ascii=False)
+            os.replace(temporary_file, cache_file)
+        except OSError as e:
+            logging.warning(f"Could not write matcher cache {cache_file}: {e}")
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+    matcher = re.compile(pattern, re.IGNORECASE) if pattern is not None else None
+    return word_pairs, matcher, sequential_words
+
+# Matchers loaded in this process, keyed by dictionary file
+_matchers = {}
 
-    # Flatten the nested JSON structure
-    word_pairs = flatten_nested_json(nested_word_pairs)
+# Function to load a dictionary once per process, loading it again only when the file changes
+def get_matcher(json_file):
+    stat = os.stat(json_file)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _matchers.get(json_file)
+    if cached is None or cached[0] != signature:
+        cached = (signature, load_matcher(json_file))
+        _matchers[json_file] = cached
+    return cached[1]
+
+# Function to replace words of a text according to the word pairs. Most words
+# are found in a single pass over the text; the sequential words, whose
+# replacements could interact with other words, are then replaced one after
+# another in dictionary order, as every word used to be.
+def replace_words(content, word_pairs, matcher=None, sequential_words=None):
+    if sequential_words is None:
+        sequential_words = find_sequential_words(word_pairs)
+    if matcher is None:
+        pattern = build_matcher_pattern(word_pairs, sequential_words)
+        matcher = re.compile(pattern, re.IGNORECASE) if pattern is not None else None
+
+    # Matches are case insensitive, so look the dictionary words up in lower case
+    words_by_lower = {}
+    for word in word_pairs:
+        words_by_lower.setdefault(word.lower(), word)
+    counts = dict.fromkeys(word_pairs, 0)
+    recording = journal.is_recording()
+    changes = []
+
+    def replace_match(match):
+        matched_text = match.group()
+        word = words_by_lower.get(matched_text.lower())
+        if word is None:
+            word = next(w for w in word_pairs if w.casefold() == matched_text.casefold())
+        counts[word] += 1
+        if recording:
+            changes.append((match.start(), matched_text, word_pairs[word]))
+        return word_pairs[word]
+
+    if matcher is not None:
+        content = matcher.sub(replace_match, content)
+
+    for word in sequential_words:
+        replacement = word_pairs[word]
+        word_changes = []
+
+        def replace_sequential_match(match):
+            if recording:
+                word_changes.append((match.start(), match.group(), replacement))
+            return replacement
+
+        pattern = r'\b' + re.escape(word) + r'\b'
+        content, counts[word] = re.subn(pattern, replace_sequential_match, content, flags=re.IGNORECASE)
+        if word_changes:
+            changes = journal.compose(changes, word_changes)
+
+    for change in changes:
+        journal.add(*change)
+
+    # Track replaced words as (word, replacement, count) in dictionary order
+    replaced_words = [(word, word_pairs[word], count) for word, count in counts.items() if count]
+    metrics.add_replacements({'words': sum(counts.values())})
+    return content, replaced_words
+
+# Rules of the dictionaries loaded in this process, keyed by dictionary file
+_rules = {}
+
+# Function to list the dictionary words as rules of the build cache, each one
+# applying to the chapters holding the word forms of its word, so adding a
+# word only runs the stage again on the chapters holding it
+def indexed_rules():
+    word_pairs, _, sequential_words = get_matcher(json_file)
+    cached = _rules.get(json_file)
+    if cached is None or cached[0] is not word_pairs:
+        # A sequential word can be made by the replacement of another word, in
+        # chapters without its own word forms, so it applies to every chapter
+        sequential_words = set(sequential_words)
+        rules = [((), None, [word, replacement]) if word in sequential_words
+                 else (word_index.word_forms(word), None, [word, replacement])
+                 for word, replacement in word_pairs.items()]
+        cached = (word_pairs, word_index.prepare_rules(rules))
+        _rules[json_file] = cached
+    return cached[1]
+
+# Function to run the stage on the text of a chapter
+def process_text(text):
+    word_pairs, matcher, sequential_words = get_matcher(json_file)
+    content, replaced_words = replace_words(text, word_pairs, matcher, sequential_words)
+    log_entries = [f"{word} -> {replacement} (replaced {count} times)" for word, replacement, count in replaced_words]
+    return content, log_entries
+
+def replace_words_using_json(json_file, input_dir, output_dir, log_dir):
+    word_pairs, matcher, sequential_words = load_matcher(json_file)
 
     # Get all text files in the input directory
     txt_files = glob.glob(os.path.join(input_dir, '*.txt'))
@@ -37,17 +262,11 @@ def replace_words_using_json(json_file, input_dir, output_dir, log_dir):
         with open(input_file_txt, 'r', encoding='utf-8') as file:
             content = file.read()
 
-        # Track replaced words
+        content, replaced = replace_words(content, word_pairs, matcher, sequential_words)
         replaced_words = []
-
-        # Replace words according to the pairs in the JSON file
-        for word, replacement in word_pairs.items():
-            pattern = r'\b' + re.escape(word) + r'\b'
-            matches = re.findall(pattern, content, re.IGNORECASE)
-            if matches:
-                content, num_replacements = re.subn(pattern, replacement, content, flags=re.IGNORECASE)
-                replaced_words.append(f"{word} -> {replacement} (replaced {num_replacements} times)")
-                print(f"Replaced {word} with {replacement}: {num_replacements} times")
+        for word, replacement, num_replacements in replaced:
+            replaced_words.append(f"{word} -> {replacement} (replaced {num_replacements} times)")
+            print(f"Replaced {word} with {replacement}: {num_replacements} times")
 
         # Define the output file paths
         output_file_txt = os.path.join(output_dir, os.path.basename(input_file_txt))
@@ -66,14 +285,16 @@ def replace_words_using_json(json_file, input_dir, output_dir, log_dir):
             else:
                 file.write("No words were replaced.\n")
 
-# Usage of the function
+# Default dictionary of word pairs
 json_file = os.path.join(base_dir, 'words_dictionary/words_dictionary.json')
-input_dir = os.path.join(base_dir, 'txt_processed/6-5-es_ait_')
-output_dir = os.path.join(base_dir, 'txt_processed/7-word_replacement_')
-log_dir = os.path.join(output_dir, 'logs')
 
-# Create the output and log directories if they don't exist
-os.makedirs(output_dir, exist_ok=True)
-os.makedirs(log_dir, exist_ok=True)
+if __name__ == "__main__":
+    input_dir = os.path.join(base_dir, 'txt_processed/6-5-es_ait_')
+    output_dir = os.path.join(base_dir, 'txt_processed/7-word_replacement_')
+    log_dir = os.path.join(output_dir, 'logs')
+
+    # Create the output and log directories if they don't exist
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
 
-replace_words_using_json(json_file, input_dir, output_dir, log_dir)
+    replace_words_using_json(json_file, input_dir, output_dir, log_dir)
@@ -0,0 +1,296 @@
+import re
+import time
+import logging
+from collections import OrderedDict, deque
+
+import journal
+import metrics
+
+# Name of the SpaCy model shared by every NLP stage
+model_name = "fr_core_news_lg"
+
+# Maximum number of parsed segments kept for reuse between stages
+max_cached_segments = 50000
+
+# Defaults for nlp.pipe when parsing a stream of chapters
+default_batch_size = 64
+default_n_process = 1
+
+# Chapters longer than this number of characters are parsed and processed in
+# chunks of about this size, so the memory a stage needs does not grow with
+# the chapter. None parses every chapter whole.
+chunk_size = 100000
+
+# Tokens after the end of a chunk parsed with it, for the rules reading the
+# tokens that follow a token, like the two the paragraph merges read
+chunk_overlap_tokens = 2
+
+# Longest segment sent to the model, the default max_length of SpaCy. A longer
+# run of text without a line break or a sentence end is cut at a space.
+max_segment_length = 1000000
+
+# Segments end after a run of line breaks or after a sentence ending
+# punctuation followed by spaces, so every cut falls between whitespace and
+# the next word and the tokens of the segments are the tokens of the text
+segment_end_pattern = re.compile(r'\n\s*|[.!?…][»"”’)]*[^\S\n]+(?=[^\s»"”’)])')
+
+_nlp = None
+
+# Docs of the parsed segments, keyed by segment and then by the components they were parsed with
+_segment_docs = OrderedDict()
+
+# Function to load the SpaCy model once per process, on first use. SpaCy
+# itself is only imported here, so importing the stages stays cheap.
+def get_nlp():
+    global _nlp
+    if _nlp is None:
+        try:
+            import spacy
+            _nlp = spacy.load(model_name)
+        except Exception as e:
+            logging.error(f"Error loading SpaCy model: {e}")
+            raise
+    return _nlp
+
+# Function to describe the model in the build cache fingerprint of the stages using it
+def cache_data():
+    import spacy
+    return {
+        'model': model_name,
+        'model_version': spacy.util.get_package_version(model_name),
+        'spacy_version': spacy.__version__,
+    }
+
+# Function to split a text into segments that can be parsed independently
+def split_segments(text):
+    segments = []
+    start = 0
+    for match in segment_end_pattern.finditer(text):
+        end = match.end()
+        if end < len(text):
+            segments.append(text[start:end])
+            start = end
+    segments.append(text[start:])
+    if any(len(segment) > max_segment_length for segment in segments):
+        segments = [piece for segment in segments for piece in split_long_segment(segment)]
+    return segments
+
+# Function to cut a segment too long for the model after the last space
+# before the limit, or at the limit when there is none
+def split_long_segment(segment):
+    pieces = []
+    while len(segment) > max_segment_length:
+        cut = max(segment.rfind(' ', 0, max_segment_length), segment.rfind('\n', 0, max_segment_length)) + 1
+        if cut == 0:
+            cut = max_segment_length
+        pieces.append(segment[:cut])
+        segment = segment[cut:]
+    pieces.append(segment)
+    return pieces
+
+# Function to list the components to run for a stage needing the given ones.
+# A component listening to the shared tok2vec needs the tok2vec too, and no
+# components given means the whole pipeline.
+def required_components(components=None):
+    nlp = get_nlp()
+    if components is None:
+        return frozenset(nlp.pipe_names)
+
+    required = set(components)
+    unknown = required.difference(nlp.pipe_names)
+    if unknown:
+        raise ValueError(f"Components not in the {model_name} pipeline: {', '.join(sorted(unknown))}")
+    for name in nlp.pipe_names:
+        listening_components = getattr(nlp.get_pipe(name), 'listening_components', None)
+        if listening_components and required.intersection(listening_components):
+            required.add(name)
+    return frozenset(required)
+
+# Function to find a cached doc of a segment parsed with at least the given components
+def _cached_doc(segment, components):
+    docs = _segment_docs.get(segment)
+    if docs:
+        for cached_components, doc in docs.items():
+            if components <= cached_components:
+                _segment_docs.move_to_end(segment)
+                return doc
+    return None
+
+def _cache_segment(segment, components, doc):
+    _segment_docs.setdefault(segment, {})[components] = doc
+    _segment_docs.move_to_end(segment)
+    if len(_segment_docs) > max_cached_segments:
+        _segment_docs.popitem(last=False)
+
+def _join_docs(docs):
+    if len(docs) == 1:
+        return docs[0]
+    from spacy.tokens import Doc
+    return Doc.from_docs(docs, ensure_whitespace=False)
+
+# Function to parse a stream of chapters with nlp.pipe, yielding their docs in input order.
+# Only the segments missing from the cache are sent to the model, and only the
+# components a stage declares are run on them, with the rest of the pipeline disabled.
+# The new parses are only added to the cache when cache is true.
+def parse_many(texts, batch_size=None, n_process=None, components=None, cache=True):
+    if batch_size is None:
+        batch_size = default_batch_size
+    if n_process is None:
+        n_process = default_n_process
+
+    nlp = get_nlp()
+    components = required_components(components)
+    disabled_components = [name for name in nlp.pipe_names if name not in components]
+
+    # Chapters waiting for some of their segments, keyed by their position in the stream
+    records = OrderedDict()
+
+    # Time spent producing the input texts, which runs inside nlp.pipe but is not parsing
+    input_seconds = [0.0]
+
+    def timed_texts():
+        texts_iterator = iter(texts)
+        while True:
+            start_time = time.perf_counter()
+            text = next(texts_iterator, None)
+            input_seconds[0] += time.perf_counter() - start_time
+            if text is None:
+                return
+            yield text
+
+    def missing_segments():
+        for index, text in enumerate(timed_texts()):
+            segments = split_segments(text)
+
+            # Count every missing segment before sending any, so a chapter is
+            # only handed out once all of its segments are parsed
+            docs = [_cached_doc(segment, components) for segment in segments]
+            missing_positions = [position for position, doc in enumerate(docs) if doc is None]
+            records[index] = {'segments': segments, 'docs': docs, 'remaining': len(missing_positions)}
+            metrics.add('spacy_segments_reused', len(segments) - len(missing_positions))
+            metrics.add('spacy_segments_parsed', len(missing_positions))
+            for position in missing_positions:
+                yield segments[position], (index, position)
+
+    # Time spent in the model is counted apart from the rules run on the docs handed out
+    parsed = iter(nlp.pipe(missing_segments(), as_tuples=True, batch_size=batch_size, n_process=n_process,
+                           disable=disabled_components))
+    while True:
+        start_time = time.perf_counter()
+        input_seconds_before = input_seconds[0]
+        item = next(parsed, None)
+        metrics.add('spacy_parse_seconds',
+                    time.perf_counter() - start_time - (input_seconds[0] - input_seconds_before))
+        if item is None:
+            break
+        doc, (index, position) = item
+        record = records[index]
+        record['docs'][position] = doc
+        record['remaining'] -= 1
+        if cache:
+            _cache_segment(record['segments'][position], components, doc)
+
+        # Hand out every finished chapter at the front of the stream
+        while records and next(iter(records.values()))['remaining'] == 0:
+            yield _join_docs(records.popitem(last=False)[1]['docs'])
+
+    while records:
+        yield _join_docs(records.popitem(last=False)[1]['docs'])
+
+# Function to parse a chapter, reusing the parse of every segment left unchanged by earlier stages
+def parse(text, components=None):
+    return next(parse_many([text], n_process=1, components=components))
+
+# Function to tell whether a chapter is processed chunk by chunk
+def is_chunked(text):
+    return chunk_size is not None and len(text) > chunk_size
+
+# Function to parse a stream of chapters like parse_many, yielding every
+# chapter as (text, doc). A chapter longer than chunk_size is not parsed and
+# comes with no doc, to be processed with map_chunks.
+def parse_stream(texts, batch_size=None, n_process=None, components=None):
+    chunked_texts = deque()
+
+    def parsed_texts():
+        for text in texts:
+            if is_chunked(text):
+                chunked_texts.append(text)
+                yield ''
+            else:
+                chunked_texts.append(None)
+                yield text
+
+    for doc in parse_many(parsed_texts(), batch_size, n_process, components):
+        text = chunked_texts.popleft()
+        if text is None:
+            yield doc.text, doc
+        else:
+            yield text, None
+
+# Function to parse a text in chunks of about chunk_size characters, cut
+# between segments. Every chunk comes with the segments after it holding at
+# least chunk_overlap_tokens tokens, the overlap, which starts the next chunk.
+# Yields the doc of every chunk and its overlap, with the length of the chunk.
+# The parses of the chunks are not kept in the segment cache, so the memory
+# used stays bounded by the chunk size whatever the length of the chapter.
+def parse_chunks(text, components=None):
+    chunk = []
+    chunk_length = 0
+    overlap = []
+    overlap_tokens = 0
+    for doc in parse_many(split_segments(text), n_process=1, components=components, cache=False):
+        if not overlap and (not chunk or chunk_length + len(doc.text) <= chunk_size):
+            chunk.append(doc)
+            chunk_length += len(doc.text)
+            continue
+
+        overlap.append(doc)
+        overlap_tokens += len(doc)
+        if overlap_tokens >= chunk_overlap_tokens:
+            yield _join_docs(chunk + overlap), chunk_length
+            chunk = overlap
+            chunk_length = sum(len(overlap_doc.text) for overlap_doc in overlap)
+            overlap = []
+            overlap_tokens = 0
+
+    # The text ended inside the overlap, which then makes the last chunk
+    if overlap:
+        yield _join_docs(chunk + overlap), chunk_length
+        chunk = overlap
+        chunk_length = sum(len(overlap_doc.text) for overlap_doc in overlap)
+    if chunk:
+        yield _join_docs(chunk), chunk_length
+
+# Function to run the rules of a stage on a long text chunk by chunk, yielding
+# their result for every chunk. rules(doc, start, end) handles the tokens of
+# the doc from the character start to the end of the chunk, reading the
+# overlap when it needs the tokens that follow, and returns its result with
+# the character it stopped at, past the end when it took in tokens of the
+# overlap. The next chunk starts after those. The journal offsets of the rules
+# are moved to the offsets of the text.
+def map_chunks(text, rules, components=None):
+    start = 0
+    offset = 0
+    for doc, end in parse_chunks(text, components):
+        with journal.shifted(offset):
+            result, stop = rules(doc, start, end)
+        yield result
+        start = max(stop - end, 0)
+        offset += end
+
+# Function to find the tokens of a doc starting between two characters, as a range of token indices
+def token_range(doc, start, end):
+    import numpy
+    from spacy.attrs import IDX
+    token_starts = doc.to_array(IDX)
+    return range(int(numpy.searchsorted(token_starts, start)), int(numpy.searchsorted(token_starts, end)))
+
+# Function to read text files lazily so they can be fed to parse_many
+def read_text_files(file_paths):
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            yield file.read()
+
+# Function to drop every cached segment
+def clear_cache():
+    _segment_docs.clear()
@@ -1,53 +1,128 @@
 #!/usr/bin/env python3
 import os
 import re
+import itertools
 from config import base_dir  # Import the base directory
 
-def split_into_chapters(text):
-    # Split the text by chapter markers
-    chapter_splits = re.split(r'(@@ .*? @@)', text, flags=re.DOTALL)
-    chapters = []
+# Size in characters of the blocks read from a book when streaming it
+read_block_size = 1 << 20
+
+# Function to read a file lazily in blocks of characters
+def read_blocks(file):
+    return iter(lambda: file.read(read_block_size), '')
+
+# Function to split a stream of text blocks around the chapter markers, yielding
+# the same pieces as re.split(r'(@@ .*? @@)', text, flags=re.DOTALL) as soon as
+# each one is read. A marker is the first '@@ ' followed by the first ' @@' after it.
+def split_marked_pieces(blocks):
+    piece = []
+    marker = None
+    marker_length = 0
+    carry = ''
+
+    for block in blocks:
+        buffer = carry + block
+        while True:
+            if marker is None:
+                start = buffer.find('@@ ')
+                if start == -1:
+                    # Keep the end of the block in case a marker starts across blocks
+                    piece.append(buffer[:-2])
+                    carry = buffer[-2:]
+                    break
+                piece.append(buffer[:start])
+                buffer = buffer[start:]
+                marker = []
+                marker_length = 0
+
+            # The closing ' @@' can not overlap the opening '@@ '
+            end = buffer.find(' @@', max(0, 3 - marker_length))
+            if end == -1:
+                marker.append(buffer[:-2])
+                marker_length += len(marker[-1])
+                carry = buffer[-2:]
+                break
+            marker.append(buffer[:end + 3])
+            yield ''.join(piece)
+            yield ''.join(marker)
+            buffer = buffer[end + 3:]
+            piece = []
+            marker = None
+
+    # A marker left open is not a marker, it stays in the last piece
+    yield ''.join(piece + (marker or []) + [carry])
+
+# Function to pair the pieces of a split text into chapter titles and contents
+def pair_chapters(pieces):
+    pieces = iter(pieces)
 
     # Ensure the split text includes titles and contents
-    if chapter_splits[0].strip() == '':
-        chapter_splits = chapter_splits[1:]
+    first_piece = next(pieces, '')
+    if first_piece.strip() != '':
+        pieces = itertools.chain([first_piece], pieces)
 
-    for i in range(0, len(chapter_splits), 2):
-        chapter_title = chapter_splits[i].strip()
-        chapter_content = chapter_splits[i + 1].strip() if (i + 1) < len(chapter_splits) else ''
-        chapters.append((chapter_title, chapter_content))
+    for chapter_title in pieces:
+        chapter_content = next(pieces, '')
+        yield chapter_title.strip(), chapter_content.strip()
 
-    return chapters
+def split_into_chapters(text):
+    # Split the text by chapter markers
+    return list(pair_chapters(split_marked_pieces([text])))
 
-def process_text_file(input_file_path, output_directory, info_output_directory):
-    with open(input_file_path, 'r', encoding='utf-8') as file:
-        text = file.read()
+# Function to split a stream of text blocks into its book info and a generator
+# of chapter files, reading the book only as far as the chapter being produced
+def split_book_stream(blocks):
+    blocks = iter(blocks)
+    book_info = []
+    carry = ''
 
-    # Extract and save book info before the first @@ marker
-    if '@@' in text:
-        book_info = text.split('@@', 1)[0].strip()
-        info_file_path = os.path.join(info_output_directory, os.path.basename(input_file_path).replace('.txt', '_info.txt'))
-        with open(info_file_path, 'w', encoding='utf-8') as info_file:
-            info_file.write(book_info)
-        print(f"Book info saved to: {info_file_path}")
+    # Extract book info before the first @@ marker
+    for block in blocks:
+        buffer = carry + block
+        index = buffer.find('@@')
+        if index != -1:
+            book_info.append(buffer[:index])
 
-        # Start processing from the first @@ marker
-        text = text.split('@@', 1)[1]
-        text = '@@' + text  # Add the marker back to the beginning
+            # Start processing from the first @@ marker
+            text_blocks = itertools.chain([buffer[index:]], blocks)
+            return ''.join(book_info).strip(), name_chapters(text_blocks)
+        book_info.append(buffer[:-1])
+        carry = buffer[-1:]
 
-    chapters = split_into_chapters(text)
+    return None, name_chapters([''.join(book_info) + carry])
 
-    for index, (title, content) in enumerate(chapters):
+# Function to name and format the chapters of a stream of text blocks
+def name_chapters(blocks):
+    for index, (title, content) in enumerate(pair_chapters(split_marked_pieces(blocks))):
         chapter_number = re.findall(r'\d+', title)[0] if re.findall(r'\d+', title) else str(index + 1)
         output_file_name = f"Chapitre_{chapter_number}.txt"
-        output_file_path = os.path.join(output_directory, output_file_name)
-        
+
         # Format the content with the chapter title starting at the beginning of the file
         formatted_content = f"{title}\n\n{content}"
+        yield output_file_name, formatted_content.strip()
+
+# Function to split a book into its book info and chapter files
+def split_book(text):
+    book_info, chapters = split_book_stream([text])
+    return book_info, list(chapters)
+
+# Function to split a book file, writing every chapter as soon as it is read
+def process_text_file(input_file_path, output_directory, info_output_directory):
+    with open(input_file_path, 'r', encoding='utf-8') as file:
+        book_info, chapters = split_book_stream(read_blocks(file))
+
+        # Save book info found before the first @@ marker
+        if book_info is not None:
+            info_file_path = os.path.join(info_output_directory, os.path.basename(input_file_path).replace('.txt', '_info.txt'))
+            with open(info_file_path, 'w', encoding='utf-8') as info_file:
+                info_file.write(book_info)
+            print(f"Book info saved to: {info_file_path}")
 
-        with open(output_file_path, 'w', encoding='utf-8') as file:
-            file.write(formatted_content.strip())
-        print(f"Processed file saved to: {output_file_path}")
+        for output_file_name, content in chapters:
+            output_file_path = os.path.join(output_directory, output_file_name)
+            with open(output_file_path, 'w', encoding='utf-8') as file:
+                file.write(content)
+            print(f"Processed file saved to: {output_file_path}")
 
 def process_directory(input_directory, output_directory, info_output_directory):
     if not os.path.exists(output_directory):
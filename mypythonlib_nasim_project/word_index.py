@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import logging
+import argparse
+import threading
+
+import build_cache
+
+# Version of the layout of the index file
+index_format_version = 1
+
+# Name of the index file, kept in the build cache directory of a book
+index_file_name = "word_index.json"
+
+# Word forms are the runs of word characters, case folded, so every word a
+# case insensitive \b...\b match can find is a word form of the text
+word_pattern = re.compile(r'\w+')
+
+# Indexes loaded in this process, keyed by build cache directory
+_indexes = {}
+_lock = threading.Lock()
+
+# Function to list the word forms of a text, like a dictionary word or a name
+def word_forms(text):
+    return tuple(dict.fromkeys(match.group().casefold() for match in word_pattern.finditer(text)))
+
+# Function to build an empty index. The postings map every word form to the
+# documents holding it and its offsets there, a document being the input of
+# a stage for a chapter, and the documents map to the hash of their text.
+def new_index():
+    return {'documents': {}, 'postings': {}, 'forms': {}, 'changed': False}
+
+# Function to load the index of a book, or start a new one
+def load_index(file_path):
+    index = new_index()
+    if not os.path.exists(file_path):
+        return index
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            stored = json.load(file)
+        if stored.get('version') != index_format_version:
+            return index
+        index['documents'] = stored['documents']
+        index['postings'] = stored['postings']
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Ignoring unreadable word index {file_path}: {e}")
+        return new_index()
+
+    # Keep the forms of every document too, to look its rules up and to drop it
+    for form, documents in index['postings'].items():
+        for document in documents:
+            index['forms'].setdefault(document, set()).add(form)
+    return index
+
+# Function to write an index, if it changed since it was loaded
+def save_index(index, file_path):
+    if not index['changed']:
+        return
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    temporary_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump({'version': index_format_version, 'documents': index['documents'], 'postings': index['postings']},
+                  file, ensure_ascii=False)
+    os.replace(temporary_path, file_path)
+    index['changed'] = False
+
+# Function to take a document out of the index
+def remove_document(index, document):
+    for form in index['forms'].pop(document, ()):
+        documents = index['postings'][form]
+        del documents[document]
+        if not documents:
+            del index['postings'][form]
+    if index['documents'].pop(document, None) is not None:
+        index['changed'] = True
+
+# Function to index the text of a document, only reading it again when it
+# changed. Returns the word forms of the document.
+def update_document(index, document, text):
+    text_hash = build_cache.hash_text(text)
+    with _lock:
+        if index['documents'].get(document) == text_hash:
+            return index['forms'][document]
+        remove_document(index, document)
+
+        postings = index['postings']
+        forms = set()
+        for match in word_pattern.finditer(text):
+            form = match.group().casefold()
+            forms.add(form)
+            postings.setdefault(form, {}).setdefault(document, []).append(match.start())
+        index['forms'][document] = forms
+        index['documents'][document] = text_hash
+        index['changed'] = True
+        return index['forms'][document]
+
+# Function to find the documents holding every word form of a text, with the offsets of its first form
+def find_documents(index, text):
+    forms = word_forms(text)
+    if not forms:
+        return {}
+    documents = index['postings'].get(forms[0], {})
+    return {document: offsets for document, offsets in documents.items()
+            if all(document in index['postings'].get(form, {}) for form in forms[1:])}
+
+# Function to load the index kept in a build cache directory once per process
+def get_index(cache_directory):
+    with _lock:
+        index = _indexes.get(cache_directory)
+        if index is None:
+            index = load_index(os.path.join(cache_directory, index_file_name))
+            _indexes[cache_directory] = index
+        return index
+
+# Function to write the index of a build cache directory, if it was loaded in this process
+def save(cache_directory):
+    with _lock:
+        index = _indexes.get(cache_directory)
+        if index is not None:
+            save_index(index, os.path.join(cache_directory, index_file_name))
+
+# Function to prepare the rules of a stage for lookups by word form. Every rule
+# is given as (forms, suffix, data): it applies to the documents holding every
+# one of its word forms, or a word form ending with its suffix, and a rule with
+# neither applies to every document. The data of a rule is what its cache key
+# covers, so it has to hold everything the rule changes in the output.
+def prepare_rules(rules):
+    prepared = {'by_form': {}, 'by_suffix': {}, 'everywhere': [], 'data': []}
+    for position, (forms, suffix, data) in enumerate(rules):
+        prepared['data'].append(data)
+        if suffix:
+            prepared['by_suffix'].setdefault(suffix.casefold(), []).append(position)
+        elif forms:
+            prepared['by_form'].setdefault(forms[0], []).append((position, forms[1:]))
+        else:
+            prepared['everywhere'].append(position)
+    prepared['longest_suffix'] = max(map(len, prepared['by_suffix']), default=0)
+    return prepared
+
+# Function to list the data of the rules applying to a document with the given
+# word forms, in the order of the rules
+def relevant_rules(forms, prepared):
+    by_form = prepared['by_form']
+    by_suffix = prepared['by_suffix']
+    longest_suffix = prepared['longest_suffix']
+
+    positions = set(prepared['everywhere'])
+    for form in forms:
+        for position, other_forms in by_form.get(form, ()):
+            if all(other_form in forms for other_form in other_forms):
+                positions.add(position)
+        for length in range(1, min(len(form), longest_suffix) + 1):
+            positions.update(by_suffix.get(form[-length:], ()))
+    return [prepared['data'][position] for position in sorted(positions)]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Find the chapters of a book holding words, from its word index.")
+    parser.add_argument("cache_directory", help="build cache directory of the book, holding its word index")
+    parser.add_argument("words", nargs="+", help="words or names to look up, case insensitive")
+    parser.add_argument("--stage", help="only show the documents of the stages whose module contains this text")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    index = load_index(os.path.join(args.cache_directory, index_file_name))
+    for word in args.words:
+        documents = find_documents(index, word)
+        if args.stage is not None:
+            documents = {document: offsets for document, offsets in documents.items()
+                         if args.stage in document.split('/', 1)[0]}
+        print(f"{word}: {len(documents)} chapters")
+        for document, offsets in sorted(documents.items()):
+            shown_offsets = ", ".join(map(str, offsets[:10])) + (", ..." if len(offsets) > 10 else "")
+            print(f"  {document:<48} {len(offsets):>6}  {shown_offsets}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import re
+
+# Function to build a trie of words, where an empty key marks the end of a word
+def build_trie(words):
+    trie = {}
+    for word in words:
+        if not word:
+            continue
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return trie
+
+# Function to build a regex alternation from a trie of words, so that the
+# regex engine never tries the same prefix twice at a position
+def trie_pattern(node):
+    if '' in node and len(node) == 1:
+        return None
+
+    alternatives = []
+    single_chars = []
+    for char in sorted(key for key in node if key):
+        sub_pattern = trie_pattern(node[char])
+        if sub_pattern is None:
+            single_chars.append(re.escape(char))
+        else:
+            alternatives.append(re.escape(char) + sub_pattern)
+
+    if len(single_chars) == 1:
+        alternatives.append(single_chars[0])
+    elif single_chars:
+        alternatives.append('[' + ''.join(single_chars) + ']')
+
+    if len(alternatives) == 1 and '' not in node:
+        return alternatives[0]
+    pattern = '(?:' + '|'.join(alternatives) + ')'
+    if '' in node:
+        pattern += '?'
+    return pattern
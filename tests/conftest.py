@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Make the stage modules and config importable the way main.py does
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repository_dir)
+sys.path.append(os.path.join(repository_dir, 'mypythonlib_nasim_project'))
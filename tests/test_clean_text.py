@@ -0,0 +1,49 @@
+import pytest
+
+import clean_text
+import journal
+
+# Function to clean a chapter the way the stage did before clean_paragraphs,
+# running every rule of clean_text on each line
+def clean_line_by_line(text):
+    return '\n'.join(clean_text.clean_text(paragraph) for paragraph in text.split('\n'))
+
+@pytest.mark.parametrize('text', [
+    '',
+    '\n',
+    '\n\n\n',
+    'Un paragraphe.\n\n\n\nUn autre paragraphe.',
+    '  \n \t \n\n',
+    'Ligne une\r\nLigne deux\r\n\r\n',
+    'Fin de ligne \r\n  début de ligne',
+    '   espaces au début et à la fin   ',
+    '\t tabulation et espace insécable \t',
+    '...',
+    ' ! ? ; : \n , . \n',
+    '!!!\n???\n;;;',
+    'Quoi ?Vraiment .Oui,non;peut-être:si',
+    'mot - composé et mot -composé et mot- composé',
+    '— Oui, dit-il.—  Non ,  répondit-elle !',
+    '@@ Chapitre 1 Le titre @@\n\nTexte',
+    '@@@',
+    'a\x0bb\x0cc\x1cd\x85e',
+])
+def test_clean_paragraphs_matches_clean_text_on_each_line(text):
+    assert clean_text.clean_paragraphs(text) == clean_line_by_line(text)
+
+def test_process_text_matches_clean_text_on_each_line():
+    text = 'Il dit :« Bonjour »\n\n  — Bonjour ,répondit-elle .  \r\n\n@@ Chapitre 2 @@'
+    assert clean_text.process_text(text) == (clean_line_by_line(text), [])
+
+def test_clean_lines_matches_clean_text_on_each_line():
+    lines = ['  Une ligne .\n', '\n', 'Une autre -ligne\n', 'fin  ']
+    assert ''.join(clean_text.clean_lines(lines)) == clean_line_by_line(''.join(lines))
+
+def test_clean_paragraphs_journal_offsets():
+    text = '@@ Chapitre 1 @@  \nQuoi ?Vraiment .Oui,non\n\t mot - composé@@ et — mot ;fin  '
+    with journal.recording() as changes:
+        cleaned_text = clean_text.clean_paragraphs(text)
+    for offset, old, new in reversed(changes):
+        assert text[offset:offset + len(old)] == old
+        text = text[:offset] + new + text[offset + len(old):]
+    assert text == cleaned_text
@@ -0,0 +1,101 @@
+import re
+
+import pytest
+
+import fix_lines
+import journal
+
+# Words the lexicon knows in these tests, so they do not load a SpaCy model
+known_words = {'mot', 'été', 'é', 'abc', 'éabc'}
+
+@pytest.fixture(autouse=True)
+def lexicon(monkeypatch):
+    monkeypatch.setattr(fix_lines, 'is_valid_word', lambda word: word in known_words)
+
+@pytest.mark.parametrize('text, expected', [
+    # A known word is merged with the next line, whatever case it starts with
+    ('Un mot-\nSuite', 'Un motSuite'),
+    # A broken word is merged when its second part starts in lower case
+    ('Il a par-\nlé', 'Il a parlé'),
+    # Neither rule applies
+    ('Un Nom-\nSuite', 'Un Nom-\nSuite'),
+    # A known word only takes in the blank line following it, and the text
+    # after it stays on its own line
+    ('mot-\n\nSuite', 'mot\nSuite'),
+    ('Un mot-\n\n  Suite', 'Un mot\n  Suite'),
+    ('Un mot-\n\n', 'Un mot'),
+    # An unknown word is kept with its hyphen and blank line
+    ('Nom-\n\nSuite', 'Nom-\n\nSuite'),
+    # A word whose second part starts in lower case is merged past blank lines
+    ('Il a par-\n \n\nlé', 'Il a parlé'),
+    ('Il a par-\n  \n', 'Il a par-'),
+])
+def test_fix_broken_hyphens(text, expected):
+    assert fix_lines.fix_broken_hyphens(text)[0] == expected
+
+@pytest.mark.parametrize('text, expected', [
+    ('é-\nabc-\n\na b-', 'éabca b-'),
+    ('par-\nta-\nge', 'partage'),
+    # "été" is checked on its own line before "Été" is merged with it
+    ('Été-\nété-\nSuite', 'ÉtéétéSuite'),
+    # The merged word "éabc" is checked by the next pass
+    ('é-\nabc-\nSuite', 'éabcSuite'),
+    ('é-\nab-\nSuite', 'éab-\nSuite'),
+])
+def test_fix_broken_hyphens_chains(text, expected):
+    assert fix_lines.fix_broken_hyphens(text)[0] == expected
+
+# Function to run the hyphen repair of the old scans on a text until it no longer changes it
+def repair_until_settled(text):
+    while True:
+        lines = text.splitlines()
+        corrected_lines = []
+        i = 0
+        while i < len(lines):
+            line = lines[i].rstrip()
+            if line.endswith('-') and i + 1 < len(lines):
+                last_word = line.split()[-1]
+                parts = last_word.split('-')
+                if len(parts) == 2 and parts[0] + parts[1] in known_words:
+                    line = line[:-len(last_word)] + parts[0] + parts[1] + lines[i + 1].lstrip()
+                    i += 1
+            corrected_lines.append(line)
+            i += 1
+        repaired_text = re.sub(r'([a-zàâçéèêëîïôûùüÿñæœ,;])-\s*\n\s*([a-zàâçéèêëîïôûùüÿñæœ])', r'\1\2',
+                               '\n'.join(corrected_lines))
+        if repaired_text == text:
+            return text
+        text = repaired_text
+
+@pytest.mark.parametrize('text', [
+    'mot-\n\n-\nété-\n\nSuite\n',
+    'Été-\nété-\n \né-\nabc-\n\nab, c-\n\n\nd\n\n',
+    'a-\nb-\nc-\nd-\né\n  Un mot- \r\n-\nsuite\n',
+])
+def test_fix_broken_hyphens_settles_like_the_old_scans(text):
+    assert fix_lines.fix_broken_hyphens(text)[0] == repair_until_settled(text)
+
+def test_fix_broken_hyphens_logs_known_words():
+    assert fix_lines.fix_broken_hyphens('Un mot-\nSuite et par-\nlé')[1] == ["Removed hyphen in: mot- -> mot"]
+
+def test_fix_broken_hyphens_journal_offsets():
+    text = 'é-\nabc-\n\n  a b-\nIl a par-\n \nlé\nUn mot-  \n\n Suite\n\n \n'
+    with journal.recording() as changes:
+        fixed_text, _ = fix_lines.fix_broken_hyphens(text)
+    for offset, old, new in reversed(changes):
+        assert text[offset:offset + len(old)] == old
+        text = text[:offset] + new + text[offset + len(old):]
+    assert text == fixed_text
+
+@pytest.mark.parametrize('text', [
+    '',
+    'Chapitre 1\r\nLe titre\r\nUn mot-\r\n\r\nSuite et par-\nlé,\nencore\n',
+    'Une ligne seule',
+])
+def test_fix_line_breaks_journal_offsets(text):
+    with journal.recording() as changes:
+        fixed_text, _ = fix_lines.fix_line_breaks(text)
+    for offset, old, new in reversed(changes):
+        assert text[offset:offset + len(old)] == old
+        text = text[:offset] + new + text[offset + len(old):]
+    assert text == fixed_text
@@ -0,0 +1,28 @@
+import pytest
+
+num2words = pytest.importorskip('num2words').num2words
+
+import number_words
+
+# Thousands whose words change before "mille", like "quatre-vingts" and "deux cents"
+edge_thousands = [1, 2, 20, 21, 71, 80, 81, 99, 100, 101, 180, 200, 280, 300, 380, 999]
+
+def test_numbers_below_three_thousand():
+    for number in range(3000):
+        assert number_words.number_to_words(number) == num2words(number, lang='fr')
+
+@pytest.mark.parametrize('thousands', edge_thousands)
+def test_numbers_around_mille(thousands):
+    for rest in [0, 1, 21, 80, 100, 200, 999]:
+        number = thousands * 1000 + rest
+        assert number_words.number_to_words(number) == num2words(number, lang='fr')
+
+def test_numbers_up_to_a_million():
+    for number in range(3000, 1000000, 997):
+        assert number_words.number_to_words(number) == num2words(number, lang='fr')
+
+def test_numbers_to_words_writes_every_number_once():
+    assert number_words.numbers_to_words(['80', '80000', '80']) == {
+        '80': num2words(80, lang='fr'),
+        '80000': num2words(80000, lang='fr'),
+    }
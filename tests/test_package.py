@@ -0,0 +1,16 @@
+import os
+import sys
+import shutil
+import subprocess
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_package_imports_without_config(tmp_path):
+    # Copy of the package alone, without the config.py of the repository next to it
+    shutil.copytree(os.path.join(repository_dir, 'mypythonlib_nasim_project'),
+                    tmp_path / 'mypythonlib_nasim_project',
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    environment = {key: value for key, value in os.environ.items() if key != 'PYTHONPATH'}
+    result = subprocess.run([sys.executable, '-c', 'import mypythonlib_nasim_project; print(mypythonlib_nasim_project.main)'],
+                            cwd=tmp_path, env=environment, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,54 @@
+import re
+
+import pytest
+
+import journal
+import replace_words
+
+# Function to replace the words the way the stage did before the single pass
+# matcher, one dictionary entry after another in dictionary order
+def replace_one_after_another(content, word_pairs):
+    replaced_words = []
+    for word, replacement in word_pairs.items():
+        pattern = r'\b' + re.escape(word) + r'\b'
+        content, count = re.subn(pattern, lambda match: replacement, content, flags=re.IGNORECASE)
+        if count:
+            replaced_words.append((word, replacement, count))
+    return content, replaced_words
+
+# Function to apply recorded changes to the text they were recorded on
+def apply_changes(text, changes):
+    for offset, old, new in reversed(changes):
+        assert text[offset:offset + len(old)] == old
+        text = text[:offset] + new + text[offset + len(old):]
+    return text
+
+word_pairs_list = [
+    # Overlapping entries: the first one in the dictionary wins
+    {'chat noir': 'matou', 'le chat': 'la chatte'},
+    {'le chat': 'la chatte', 'chat noir': 'matou'},
+    {'chat': 'chien', 'le chat': 'le félin'},
+    # Chained entries: a replacement is found again by a later entry
+    {'chat': 'chien', 'chien': 'loup'},
+    {'chien': 'loup', 'chat': 'chien'},
+    {'chat': 'le chien', 'le chien': 'le loup', 'noir': 'gris'},
+    # Replacements breaking or making the boundaries of other words
+    {'noir': '', 'chat  mange': 'repas'},
+    {'noir': '-', 'chat-': 'x'},
+    {'Chat': 'Minou', 'chat': 'chien'},
+    # Entries not interacting, all found in the single pass
+    {'chat': 'chien', 'noir': 'gris', 'souris': 'rat'},
+]
+
+@pytest.mark.parametrize('word_pairs', word_pairs_list)
+def test_replace_words_matches_one_entry_after_another(word_pairs):
+    text = 'Le chat noir mange. le chat  mange la souris, chat-noir et CHAT.'
+    with journal.recording() as changes:
+        result = replace_words.replace_words(text, word_pairs)
+    assert result == replace_one_after_another(text, word_pairs)
+    assert apply_changes(text, changes) == result[0]
+
+def test_only_interacting_entries_are_sequential():
+    word_pairs = {'chat noir': 'matou', 'le chat': 'la chatte', 'chien': 'loup',
+                  'souris': 'chien', 'rat': 'mulot'}
+    assert replace_words.find_sequential_words(word_pairs) == ['chat noir', 'le chat', 'chien', 'souris']